@@ -0,0 +1,68 @@
+import io
+import random
+import tracemalloc
+import pytest
+from PIL import Image, ImageDraw
+
+WORDS = ['alice', 'snowdrop', 'kitten', 'looking-glass', 'house', 'chapter', 'white', 'playing',
+         'automates', 'repetitive', 'tasks', 'through', 'human', 'observation', 'bounding', 'boxes']
+
+
+def synthetic_words(count: int, seed: int = 0) -> list[str]:
+    """Deterministic text of `count` words, a third of them unique so the pii terms can hit or miss"""
+    rng = random.Random(seed)
+    return [rng.choice(WORDS) if rng.random() < 0.66 else f'word{rng.randrange(count)}'
+            for _ in range(count)]
+
+
+def synthetic_boxes(count: int) -> list[dict]:
+    """asdict(TextBoundingBox) of `count` words laid out in lines of 12"""
+    return [dict(text=text, left=(i % 12) * 80, right=(i % 12) * 80 + 70, top=(i // 12) * 20,
+                 bottom=(i // 12) * 20 + 16) for i, text in enumerate(synthetic_words(count))]
+
+
+def synthetic_pii(count: int) -> list[str]:
+    """`count` pii terms, some of them occur in the synthetic documents"""
+    return (WORDS[:min(count, 4)] + [f'word{i * 7}' for i in range(count)])[:count]
+
+
+def synthetic_page(count: int) -> bytes:
+    """PNG page with `count` rendered words in lines of 12"""
+    words = synthetic_words(count)
+    lines = [' '.join(words[i:i + 12]) for i in range(0, count, 12)]
+    image = Image.new('L', (1000, 30 + 20 * len(lines)), color=255)
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text((15, 15 + 20 * i), line, fill=0)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def measure(benchmark):
+    """Benchmark func and record the memory of one extra call in the benchmark's extra_info:
+    allocated_blocks and allocated_bytes allocated during the call and still alive when it returns (the result
+    is kept till the second snapshot), peak_bytes traced at most during the call and transient_bytes of that
+    peak freed before it returned. tracemalloc does not count blocks allocated and freed within the call,
+    their size shows in transient_bytes.
+    """
+    def run(func, *args, **kwargs):
+        result = benchmark(func, *args, **kwargs)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            kept = func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            del kept
+        finally:
+            tracemalloc.stop()
+        growth = after.compare_to(before, 'lineno')
+        allocated = sum(max(0, x.size_diff) for x in growth)
+        benchmark.extra_info['allocated_blocks'] = sum(max(0, x.count_diff) for x in growth)
+        benchmark.extra_info['allocated_bytes'] = allocated
+        benchmark.extra_info['peak_bytes'] = peak
+        benchmark.extra_info['transient_bytes'] = max(0, peak - allocated)
+        return result
+    return run
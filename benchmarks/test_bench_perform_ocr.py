@@ -0,0 +1,26 @@
+import pytest
+from perform_ocr import run as dut
+from common.boxes import BoxTable
+from .conftest import synthetic_boxes, synthetic_page
+
+PAGE_WORDS = [10, 100, 1000]  # tesseract bound, larger pages only repeat the same work
+DOCUMENT_WORDS = [10, 1000, 50_000]
+
+
+@pytest.mark.parametrize('text_regions', [False, True])
+@pytest.mark.parametrize('words', PAGE_WORDS)
+def test_detect_text(measure, words, text_regions):
+    page = synthetic_page(words)
+    out = measure(dut.detect_text, page, text_regions)
+    assert out
+
+
+@pytest.mark.parametrize('words', DOCUMENT_WORDS)
+def test_service_ocr_process_message(measure, mocker, words):
+    """Everything process_message does besides tesseract, the OCR result is given"""
+    mocker.patch.object(dut, 'pika', mocker.MagicMock())
+    mocker.patch.object(dut, 'detect_text',
+                        return_value=BoxTable.from_records(synthetic_boxes(words)))
+    service = dut.ServiceOCR('host', 'a', 'b', 'b')
+    out = measure(service.process_message, b'')
+    assert isinstance(out, bytes)
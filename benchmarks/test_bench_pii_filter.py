@@ -0,0 +1,28 @@
+import json
+import pytest
+from pii_filter import run as dut
+from common.boxes import BoxTable
+from .conftest import synthetic_boxes, synthetic_pii
+
+DOCUMENT_WORDS = [10, 1000, 50_000]
+PII_TERMS = [1, 1000, 100_000]
+
+
+@pytest.mark.parametrize('pii_terms', PII_TERMS)
+@pytest.mark.parametrize('words', DOCUMENT_WORDS)
+def test_filter_to_pii(measure, words, pii_terms):
+    boxes = BoxTable.from_records(synthetic_boxes(words))
+    pii = synthetic_pii(pii_terms)
+    out = measure(dut.filter_to_pii, boxes, pii)
+    assert len(out) <= len(boxes)
+
+
+@pytest.mark.parametrize('pii_terms', PII_TERMS)
+@pytest.mark.parametrize('words', DOCUMENT_WORDS)
+def test_service_filter_process_message(measure, mocker, words, pii_terms):
+    mocker.patch.object(dut, 'pika', mocker.MagicMock())
+    service = dut.ServiceFilter('host', 15, 'a', 'b', 'c')
+    message_a = json.dumps(synthetic_boxes(words)).encode()
+    message_b = json.dumps(synthetic_pii(pii_terms)).encode()
+    out = measure(service.process_message, message_a, message_b)
+    assert isinstance(out, bytes)
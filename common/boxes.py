@@ -0,0 +1,158 @@
+import sys
+from array import array
+from itertools import compress
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+COLUMNS = ('left', 'right', 'top', 'bottom')
+
+
+@dataclass(order=True)
+class TextBoundingBox:
+    """Pillow-type Bound Box.
+    Co-ordinates start in (0,0) in the Top Left Corner.
+    """
+    text: str
+    left: int
+    right: int
+    top: int
+    bottom: int
+
+
+class BoxTable:
+    """Columnar table of TextBoundingBox. Co-ordinates are int32 arrays and the text an interned list, the
+    operations work on whole columns instead of per box objects. Iterating or indexing yields TextBoundingBox.
+    Serializes to and from the list(asdict(TextBoundingBox)) records used on the queues.
+    """
+    def __init__(self, text: Iterable[str] = (), left: Iterable[int] = (), right: Iterable[int] = (),
+                 top: Iterable[int] = (), bottom: Iterable[int] = ()):
+        self.text = [sys.intern(x) for x in text]
+        self.left = array('i', left)
+        self.right = array('i', right)
+        self.top = array('i', top)
+        self.bottom = array('i', bottom)
+        if not len(self.text) == len(self.left) == len(self.right) == len(self.top) == len(self.bottom):
+            raise ValueError('BoxTable columns must have the same length')
+        self._text_lower: Optional[list[str]] = None
+
+    @classmethod
+    def from_boxes(cls, boxes: Iterable[TextBoundingBox]) -> 'BoxTable':
+        boxes = list(boxes)
+        return cls([x.text for x in boxes], *([getattr(x, c) for x in boxes] for c in COLUMNS))
+
+    @classmethod
+    def from_records(cls, records: list[dict]) -> 'BoxTable':
+        """From the list(asdict(TextBoundingBox)) message format"""
+        return cls([x['text'] for x in records], *([x[c] for x in records] for c in COLUMNS))
+
+    @classmethod
+    def concat(cls, tables: Iterable['BoxTable']) -> 'BoxTable':
+        out = cls()
+        for table in tables:
+            out.text.extend(table.text)
+            for column in COLUMNS:
+                getattr(out, column).extend(getattr(table, column))
+        return out
+
+    def to_records(self) -> list[dict]:
+        """To the list(asdict(TextBoundingBox)) message format"""
+        return [dict(text=text, left=left, right=right, top=top, bottom=bottom)
+                for text, left, right, top, bottom in zip(self.text, self.left, self.right, self.top, self.bottom)]
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def __getitem__(self, i: int) -> TextBoundingBox:
+        return TextBoundingBox(self.text[i], self.left[i], self.right[i], self.top[i], self.bottom[i])
+
+    def __iter__(self) -> Iterator[TextBoundingBox]:
+        return map(TextBoundingBox, self.text, self.left, self.right, self.top, self.bottom)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, BoxTable):
+            return NotImplemented
+        return self.text == other.text and all(getattr(self, c) == getattr(other, c) for c in COLUMNS)
+
+    def __repr__(self) -> str:
+        return f'BoxTable({list(self)})'
+
+    @property
+    def text_lower(self) -> list[str]:
+        """Lower case text column, computed once"""
+        if self._text_lower is None:
+            self._text_lower = [sys.intern(x.lower()) for x in self.text]
+        return self._text_lower
+
+    def mask(self, keep: Iterable[bool]) -> 'BoxTable':
+        """Rows where keep is true"""
+        keep = list(keep)
+        return BoxTable(compress(self.text, keep), *(compress(getattr(self, c), keep) for c in COLUMNS))
+
+    def take(self, indices: Iterable[int]) -> 'BoxTable':
+        """Rows at the given indices, in that order"""
+        indices = list(indices)
+        return BoxTable([self.text[i] for i in indices],
+                        *([getattr(self, c)[i] for i in indices] for c in COLUMNS))
+
+    def lines(self) -> list[list[int]]:
+        """Group the rows into lines of text, each a list of row indices from left to right, lines from top
+        to bottom. A box belongs to a line when its vertical centre falls within the line's first box.
+        """
+        lines: list[list[int]] = []
+        line_top = line_bottom = None
+        for i in sorted(range(len(self)), key=lambda i: (self.top[i], self.left[i])):
+            centre = (self.top[i] + self.bottom[i]) // 2
+            if lines and line_top <= centre <= line_bottom:
+                lines[-1].append(i)
+            else:
+                lines.append([i])
+                line_top, line_bottom = self.top[i], self.bottom[i]
+        for line in lines:
+            line.sort(key=self.left.__getitem__)
+        return lines
+
+    def reading_order(self) -> 'BoxTable':
+        """Rows sorted line by line, left to right"""
+        return self.take(i for line in self.lines() for i in line)
+
+    def index(self, cell: int = 64) -> 'GridIndex':
+        return GridIndex(self, cell)
+
+
+class GridIndex:
+    """Uniform grid spatial index over a BoxTable answering rectangle queries. Each box is registered in
+    every `cell` sized square it overlaps, a query only tests the boxes registered in the squares it covers.
+    """
+    def __init__(self, table: BoxTable, cell: int = 64):
+        self.table = table
+        self.cell = cell
+        self.cells: dict[tuple[int, int], array] = {}
+        for i, (left, right, top, bottom) in enumerate(zip(table.left, table.right, table.top, table.bottom)):
+            for key in self._keys(left, top, right, bottom):
+                self.cells.setdefault(key, array('i')).append(i)
+
+    def _keys(self, left: int, top: int, right: int, bottom: int) -> Iterator[tuple[int, int]]:
+        for x in range(left // self.cell, right // self.cell + 1):
+            for y in range(top // self.cell, bottom // self.cell + 1):
+                yield x, y
+
+    def query(self, left: int, top: int, right: int, bottom: int, margin: int = 0,
+              inside: bool = False) -> list[int]:
+        """Sorted row indices of the boxes intersecting the rectangle grown by margin, or with inside only
+        the boxes completely within it
+        """
+        left, top, right, bottom = left - margin, top - margin, right + margin, bottom + margin
+        candidates = set()
+        for key in self._keys(max(0, left), max(0, top), max(0, right), max(0, bottom)):
+            candidates.update(self.cells.get(key, ()))
+        t = self.table
+        if inside:
+            return sorted(i for i in candidates if left <= t.left[i] and t.right[i] <= right
+                          and top <= t.top[i] and t.bottom[i] <= bottom)
+        return sorted(i for i in candidates if t.left[i] <= right and left <= t.right[i]
+                      and t.top[i] <= bottom and top <= t.bottom[i])
+
+    def near(self, i: int, margin: int) -> list[int]:
+        """Sorted row indices of the boxes within margin of box i, excluding i"""
+        t = self.table
+        return [x for x in self.query(t.left[i], t.top[i], t.right[i], t.bottom[i], margin) if x != i]
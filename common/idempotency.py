@@ -0,0 +1,73 @@
+import time
+import sqlite3
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+
+class CompletedStore:
+    """Completed correlation ids in a sqlite file, shared by the replicas running on one host"""
+    def __init__(self, path: str, window: float, prune_every: int = 1000):
+        self.window = window
+        self.prune_every = prune_every
+        self.added = 0
+        self.db = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent, no fsync per insert
+        self.db.execute('CREATE TABLE IF NOT EXISTS completed (id TEXT PRIMARY KEY, at REAL NOT NULL)')
+
+    def add(self, key: str, now: float) -> None:
+        self.db.execute('INSERT OR REPLACE INTO completed VALUES (?, ?)', (key, now))
+        self.added += 1
+        if self.added % self.prune_every == 0:
+            self.db.execute('DELETE FROM completed WHERE at < ?', (now - self.window,))
+
+    def seen(self, key: str, now: float) -> bool:
+        return self.db.execute('SELECT 1 FROM completed WHERE id = ? AND at >= ?',
+                               (key, now - self.window)).fetchone() is not None
+
+
+class CompletedMessages:
+    """Bounded, time-windowed record of the correlation ids a service already completed.
+    Ids are remembered for at most `window` seconds and, locally, only the last `size` of them in an LRU: above
+    size / window completions per second (about 28/s with the defaults) ids drop out before their window ends.
+    With `path` the ids are also written to a CompletedStore, which keeps them for the whole window, so
+    replicas on the same host see each other's work. It is consulted whenever the local record does not
+    know the id, which is every new message: one indexed sqlite lookup per message.
+    """
+    def __init__(self, size: int = 100_000, window: float = 3600, path: Optional[str] = None):
+        self.size = size
+        self.window = window
+        self.recent: OrderedDict[str, float] = OrderedDict()  # correlation_id: completed at
+        self.store = CompletedStore(path, window) if path else None
+        self.duplicates = 0
+
+    def add(self, correlation_id: Optional[str]) -> None:
+        """Record a completed message"""
+        if correlation_id is None:
+            return
+        now = time.time()
+        self.recent[correlation_id] = now
+        self.recent.move_to_end(correlation_id)
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+        if self.store is not None:
+            self.store.add(correlation_id, now)
+
+    def __contains__(self, correlation_id: Optional[str]) -> bool:
+        if correlation_id is None:
+            return False
+        now = time.time()
+        completed = self.recent.get(correlation_id)
+        if completed is not None and now - completed < self.window:
+            return True
+        return self.store is not None and self.store.seen(correlation_id, now)
+
+    def skip(self, correlation_id: Optional[str]) -> bool:
+        """True if the message was already completed, counting it as a duplicate"""
+        if correlation_id in self:
+            self.duplicates += 1
+            return True
+        return False
@@ -0,0 +1,59 @@
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+log = logging.getLogger(__name__)
+
+
+class Probes:
+    """Liveness and readiness state of a service, optionally served over HTTP.
+    GET /live answers 200 while the service loop is alive, i.e. it called heartbeat within the last `live_timeout`
+    seconds, and GET /ready answers 200 once the service is connected, warmed up and consuming. Both answer 503
+    otherwise, so a loop wedged in a call that never returns fails the liveness probe.
+    Services add their own GET endpoints to `routes`, each a callable returning the response body.
+    """
+    def __init__(self, port: Optional[int] = None, live_timeout: float = 60):
+        self.live = True
+        self.live_timeout = float(live_timeout)
+        self.beat = time.monotonic()
+        self.ready = False
+        self.port = port
+        self.server = None
+        self.routes: dict[str, Callable[[], bytes]] = {}
+
+    def heartbeat(self) -> None:
+        """Called by the service loop on every iteration, including idle ones"""
+        self.beat = time.monotonic()
+
+    def status(self, path: str) -> Optional[bool]:
+        """Probe state for the requested path, None if the path is not a probe"""
+        live = self.live and time.monotonic() - self.beat < self.live_timeout
+        return {'/live': live, '/ready': self.ready}.get(path)
+
+    def serve(self) -> None:
+        """Serve the probes from a daemon thread, does nothing if no port was given"""
+        if not self.port or self.server is not None:
+            return
+        probes = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path in probes.routes:
+                    body = probes.routes[self.path]()
+                    self.send_response(200)
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                state = probes.status(self.path)
+                code = 404 if state is None else 200 if state else 503
+                self.send_response(code)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass  # probes are polled often, keep them out of the service log
+
+        self.server = ThreadingHTTPServer(('', int(self.port)), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f'Serving probes on port {self.port}')
@@ -0,0 +1,183 @@
+import os
+import math
+import time
+import signal
+import cProfile
+import logging
+import tracemalloc
+from contextlib import contextmanager
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+
+class SectionTimers:
+    """Cumulative wall clock timers for the sections of a service loop.
+    Cheap enough to stay enabled in production: one perf_counter pair and a dict update per section.
+    """
+    def __init__(self):
+        self.stats: dict[str, list] = {}  # name: [count, total seconds, max seconds]
+
+    def add(self, name: str, seconds: float) -> None:
+        """Record one run of a section"""
+        stat = self.stats.get(name)
+        if stat is None:
+            self.stats[name] = [1, seconds, seconds]
+        else:
+            stat[0] += 1
+            stat[1] += seconds
+            if seconds > stat[2]:
+                stat[2] = seconds
+
+    @contextmanager
+    def section(self, name: str):
+        """Time the body of the with statement as the named section"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def summary(self) -> dict:
+        """Count, total, mean and max time in seconds per section"""
+        return {name: dict(count=count, total=total, mean=total / count, max=max_)
+                for name, (count, total, max_) in list(self.stats.items())}
+
+
+class Profiling:
+    """On-demand cProfile and tracemalloc snapshots of a running service.
+    SIGUSR1 toggles cProfile, a started profile stops by itself after `seconds` and is written to
+    `directory` as a .prof file (open it with pstats or snakeviz). SIGUSR2 starts tracemalloc on the first
+    signal and on every following one writes a snapshot plus a text report of the top allocation sites
+    that grew since the previous snapshot, tracing stops by itself `seconds` after it started (after a final
+    snapshot). `seconds` <= 0 means no time limit. At most `max_files` files are written per process.
+    The signals are handled in the main thread, which is the one running the service loop, so other threads
+    (e.g. the HTTP probes) trigger them with os.kill. The HTTP endpoints are only served for an explicit
+    `directory`.
+    """
+    def __init__(self, directory: Optional[str] = None, seconds: float = 30, top: int = 25, max_files: int = 50):
+        self.endpoints = directory is not None
+        self.directory = directory or '/tmp'
+        self.seconds = float(seconds)
+        self.top = top
+        self.max_files = max_files
+        self.profile: Optional[cProfile.Profile] = None
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.deadlines: dict[str, float] = {}  # profile/trace: time.monotonic() to stop at
+        self.files = 0
+
+    def install(self) -> None:
+        """Register the signal handlers, must be called from the main thread"""
+        signal.signal(signal.SIGUSR1, lambda sig, frame: self.toggle_profile())
+        signal.signal(signal.SIGUSR2, lambda sig, frame: self.take_snapshot())
+        signal.signal(signal.SIGALRM, lambda sig, frame: self.expire())
+
+    def path(self, suffix: str) -> str:
+        self.files += 1
+        return os.path.join(self.directory,
+                            f'{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}-{self.files}.{suffix}')
+
+    def can_write(self, files: int) -> bool:
+        if self.files + files > self.max_files:
+            log.warning(f'Profiling wrote {self.files} files, the limit of {self.max_files} is reached')
+            return False
+        return True
+
+    def set_deadline(self, name: str) -> None:
+        if self.seconds > 0:
+            self.deadlines[name] = time.monotonic() + self.seconds
+            self.arm()
+
+    def clear_deadline(self, name: str) -> None:
+        if self.deadlines.pop(name, None) is not None:
+            self.arm()
+
+    def arm(self) -> None:
+        """Set the alarm for the earliest deadline, profile and trace share the one real time timer"""
+        deadline = min(self.deadlines.values(), default=math.inf)
+        seconds = 0 if deadline == math.inf else max(0.001, deadline - time.monotonic())
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    def expire(self) -> None:
+        """Stop the profile and trace whose time is up"""
+        now = time.monotonic()
+        if self.deadlines.get('profile', math.inf) <= now:
+            self.stop_profile()
+        if self.deadlines.get('trace', math.inf) <= now:
+            self.stop_tracing()
+        self.arm()
+
+    def toggle_profile(self) -> None:
+        if self.profile is None:
+            self.start_profile()
+        else:
+            self.stop_profile()
+
+    def start_profile(self) -> None:
+        if self.profile is not None:
+            return
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.set_deadline('profile')
+        log.warning(f'Profiling started for {self.seconds}s')
+
+    def stop_profile(self) -> Optional[str]:
+        """Stop profiling and write the stats, returns the file written"""
+        if self.profile is None:
+            return None
+        self.clear_deadline('profile')
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+        if not self.can_write(1):
+            return None
+        path = self.path('prof')
+        profile.dump_stats(path)
+        log.warning(f'Profiling stopped, stats written to {path}')
+        return path
+
+    def take_snapshot(self) -> Optional[str]:
+        """Start tracing allocations or write a snapshot and its growth report, returns the report file"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.set_deadline('trace')
+            log.warning(f'Tracing memory allocations for {self.seconds}s, send the signal again for a snapshot')
+            return None
+        if not self.can_write(2):
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+        snapshot.dump(self.path('snapshot'))
+        if self.snapshot is None:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self.snapshot, 'lineno')
+        self.snapshot = snapshot
+        path = self.path('tracemalloc.txt')
+        with open(path, 'w') as fh:
+            fh.writelines(f'{stat}\n' for stat in stats[:self.top])
+        log.warning(f'Memory snapshot written to {path}')
+        return path
+
+    def stop_tracing(self) -> Optional[str]:
+        """Write a final snapshot and stop tracing allocations, returns the report file"""
+        if not tracemalloc.is_tracing():
+            return None
+        self.clear_deadline('trace')
+        path = self.take_snapshot()
+        tracemalloc.stop()
+        self.snapshot = None
+        log.warning('Stopped tracing memory allocations')
+        return path
+
+    def routes(self) -> dict:
+        """HTTP endpoints for Probes.routes signalling the main thread to toggle profiling or snapshot,
+        none unless the profiles go to an explicit directory
+        """
+        if not self.endpoints:
+            return {}
+
+        def send(sig):
+            os.kill(os.getpid(), sig)
+            return b'ok\n'
+        return {'/profile': lambda: send(signal.SIGUSR1),
+                '/snapshot': lambda: send(signal.SIGUSR2)}
@@ -0,0 +1,55 @@
+import os
+
+# A full queue rejects new publishes (the publisher gets a nack) instead of growing the broker memory till
+# its watermark blocks every connection. The services pause consuming while their output queue is full.
+QUEUE_LIMITS = {
+    'ocr_in': dict(max_length=10_000, max_bytes=1 << 30),
+    'ocr_out': dict(max_length=50_000, max_bytes=256 << 20),
+    'ocr_tenant': dict(max_length=10_000, max_bytes=1 << 30),  # per tenant, ocr_tenant.<tenant>
+    'pii_sink': dict(max_length=100_000, max_bytes=256 << 20),
+}
+# Bounded queues bound to a fanout exchange. One full queue nacks a fanout publish the other bound queues already
+# received, a retry would duplicate it in those, so publishers pause while such a queue is at FANOUT_HEADROOM of its
+# length limit instead of retrying nacks. The server named (exclusive) queues of the fanouts are not bounded.
+FANOUT_BOUND = {
+    'pii_out': ['pii_sink'],
+}
+FANOUT_HEADROOM = 0.9
+
+# Lanes of a queue, e.g. ocr_in.deu for ocr_in, share its limits. Messages not consumed from a lane within the
+# ttl (milliseconds) are dead lettered to the exchange feeding the main queue, so a lane without workers drains.
+# Lanes are quorum queues with at-least-once dead lettering whatever the QUEUE_TYPE: the main queue is bounded with
+# reject-publish and the default at-most-once dead lettering would drop expired messages while it is full.
+LANE_FALLBACK = {
+    'ocr_in': dict(exchange='ocr_fallback', ttl=30_000),
+}
+
+
+def queue_arguments(queue: str) -> dict:
+    """Arguments to declare the named queue with, every client declaring the queue must use the same.
+    QUEUE_TYPE=lazy keeps the backlog of classic queues on disk and QUEUE_TYPE=quorum declares quorum queues.
+    Server named (exclusive) queues get no arguments.
+    """
+    if not queue:
+        return {}
+    arguments = {}
+    name, _, lane = queue.partition('.')
+    limits = QUEUE_LIMITS.get(name)
+    if limits:
+        arguments.update({'x-max-length': limits['max_length'],
+                          'x-max-length-bytes': limits['max_bytes'],
+                          'x-overflow': 'reject-publish'})
+    fallback = LANE_FALLBACK.get(name)
+    if lane and fallback:
+        arguments.update({'x-message-ttl': fallback['ttl'],
+                          'x-dead-letter-exchange': fallback['exchange'],
+                          'x-dead-letter-strategy': 'at-least-once',
+                          'x-overflow': 'reject-publish',  # required by at-least-once dead lettering
+                          'x-queue-type': 'quorum'})
+        return arguments
+    queue_type = os.environ.get('QUEUE_TYPE', 'classic')
+    if queue_type == 'lazy':
+        arguments['x-queue-mode'] = 'lazy'
+    elif queue_type == 'quorum':
+        arguments['x-queue-type'] = 'quorum'
+    return arguments
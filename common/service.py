@@ -0,0 +1,29 @@
+import json
+import logging
+from typing import Callable, Optional
+
+import pika
+from retry.api import retry_call
+from pika.exceptions import AMQPConnectionError
+from common.probes import Probes
+from common.profiling import Profiling
+
+log = logging.getLogger(__name__)
+
+
+def connect(host: Optional[str], tries: int = 60) -> pika.BlockingConnection:
+    """Blocking connection to the broker. It may still be starting, so back off exponentially between the
+    attempts but never wait more than a second.
+    """
+    return retry_call(pika.BlockingConnection, fargs=[pika.ConnectionParameters(host)],
+                      exceptions=AMQPConnectionError, tries=tries, delay=0.05, backoff=2, max_delay=1, logger=log)
+
+
+def serve_probes(port, live_timeout, metrics: Callable[[], dict], profiling: Optional[Profiling] = None) -> Probes:
+    """Serve the probes of a service, its metrics as JSON on /metrics and the profiling endpoints"""
+    probes = Probes(port, live_timeout)
+    probes.routes['/metrics'] = lambda: json.dumps(metrics()).encode()
+    if profiling is not None:
+        probes.routes.update(profiling.routes())
+    probes.serve()
+    return probes
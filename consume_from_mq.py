@@ -1,26 +1,54 @@
 import json
+import logging
+import argparse
 import pika
 
-connection = pika.BlockingConnection(pika.ConnectionParameters(host="127.0.0.1", port=5672))
-channel = connection.channel()
-channel.exchange_declare(exchange='pii_out', exchange_type='fanout')
-queue_name = channel.queue_declare(queue="", durable=True, exclusive=True).method.queue
-channel.queue_bind(exchange='pii_out', queue=queue_name)
 
+def print_results(host: str) -> None:
+    """Print every box of the results published to pii_out"""
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=5672))
+    channel = connection.channel()
+    channel.exchange_declare(exchange='pii_out', exchange_type='fanout')
+    queue_name = channel.queue_declare(queue="", durable=True, exclusive=True).method.queue
+    channel.queue_bind(exchange='pii_out', queue=queue_name)
 
-def callback(ch, method, properties, body):
-    print(f'Consumed {properties.correlation_id=} with message:')
-    [print(x) for x in json.loads(body.decode())]
+    def callback(ch, method, properties, body):
+        print(f'Consumed {properties.correlation_id=} with message:')
+        [print(x) for x in json.loads(body.decode())]
 
+    channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
 
-channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
+    print('Starting consume loop')
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        channel.cancel()
+        connection.close()
 
 
-print('Starting consume loop')
-try:
-    channel.start_consuming()
-except KeyboardInterrupt:
-    pass
-finally:
-    channel.cancel()
-    connection.close()
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Consume the results published to pii_out')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--sink', metavar='DIR', help='write batched results to segment files in DIR')
+    parser.add_argument('--binary', action='store_true', help='binary instead of JSONL segments')
+    parser.add_argument('--index', action='store_true', help='keep a correlation id to file offset index')
+    parser.add_argument('--batch', type=int, default=500, help='messages per fsync and acknowledge')
+    args = parser.parse_args()
+    if not args.sink:
+        print_results(args.host)
+        return
+    from pii_sink.run import SegmentWriter, ServiceSink
+
+    logging.basicConfig(level=logging.INFO)
+    service = ServiceSink(host=args.host,
+                          exchange='pii_out',
+                          queue='pii_sink',
+                          writer=SegmentWriter(args.sink, binary=args.binary, index=args.index),
+                          batch=args.batch)
+    service.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import os
 import time
 import pika
+from common.queues import queue_arguments
 
 
 def delayed_nack(ch, method, properties, body):
@@ -13,7 +14,7 @@ def main() -> None:
     channel = connection.channel()
     channel.confirm_delivery()
 
-    channel.queue_declare(queue='ocr_in', durable=True)
+    channel.queue_declare(queue='ocr_in', durable=True, arguments=queue_arguments('ocr_in'))
     channel.basic_qos(prefetch_count=1)
     channel.basic_consume(queue='ocr_in', auto_ack=False,
                           on_message_callback=delayed_nack)
@@ -0,0 +1,56 @@
+import os
+import json
+import logging
+from typing import Optional
+from perform_ocr.run import (TesseractLanguages, declare_language_routing, detect_text, message_language,
+                             warm_up_image)
+from pii_filter.run import ServiceBlockingConsumeABPublishC, filter_to_pii
+
+log = logging.getLogger(__name__)
+
+
+class ServiceOCRFilter(ServiceBlockingConsumeABPublishC):
+    """Fused OCR and filter. Consumes images from ocr_in, joins them with the pii stream in memory and
+    passes the recognised boxes straight to filter_to_pii, so only the pii_out message is published.
+    Skips the ocr_out broker round trip for deployments that do not need to scale the stages independently.
+    Replicas coordinate through the pii and pii_out fanouts exactly like the pii_filter replicas do.
+    It consumes the fallback language lane and recognises each image with the language of its `lang` header.
+    """
+    def __init__(self, *args, **kwargs):
+        self.languages = TesseractLanguages()
+        super().__init__(*args, **kwargs)
+        declare_language_routing(self.channel_consume_priority, self.consume_queue_priority)
+
+    def warm_up(self) -> None:
+        """Run the OCR on a sample image so the first message does not pay for imports and model loading"""
+        detect_text(warm_up_image())
+        self.languages.load()
+        log.info('OCR engine warmed up')
+
+    def metrics(self) -> dict:
+        return dict(super().metrics(), missing_languages=self.languages.missing)
+
+    def process_message(self, message_a: bytes, message_b: bytes, headers: Optional[dict] = None) -> bytes:
+        """Recognise the text in the image message_a and drop the boxes with the pii terms in message_b"""
+        with self.timers.section('ocr'):
+            boxes = detect_text(message_a, lang=self.languages.resolve(message_language(headers)))
+        with self.timers.section('decode'):
+            pii_texts = json.loads(message_b.decode())
+        with self.timers.section('filter'):
+            boxes = filter_to_pii(boxes, pii_texts)
+        with self.timers.section('encode'):
+            return json.dumps(boxes.to_records()).encode()
+
+
+if __name__ == '__main__':
+    service = ServiceOCRFilter(host=os.environ.get('RABBITMQ_HOST'),
+                               buffer=15,
+                               queue_a='ocr_in',
+                               exchange_b='pii',
+                               exchange_c='pii_out',
+                               probe_port=os.environ.get('PROBE_PORT'),
+                               profile_dir=os.environ.get('PROFILE_DIR'),
+                               profile_seconds=os.environ.get('PROFILE_SECONDS', 30),
+                               completed_path=os.environ.get('COMPLETED_PATH'),
+                               live_timeout=os.environ.get('LIVE_TIMEOUT', 60))
+    service.run()
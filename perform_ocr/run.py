@@ -1,82 +1,176 @@
 import io
 import os
+import re
 import csv
 import pika
 import json
+import time
 import signal
 import logging
-import pytesseract
 
-from PIL import Image
+from typing import Optional
 from abc import ABC, abstractmethod
 from dataclasses import asdict, dataclass
 from pika.exceptions import NackError, UnroutableError
+from common.boxes import BoxTable
+from common.idempotency import CompletedMessages
+from common.queues import queue_arguments
+from common.service import connect, serve_probes
+from common.scheduler import TenantScheduler, parse_tenants
+from common.profiling import Profiling, SectionTimers
 
 log = logging.getLogger(__name__)
 
-
-@dataclass(order=True)
-class TextBoundingBox:
-    """Pillow-type Bound Box.
-    Co-ordinates start in (0,0) in the Top Left Corner.
-    """
-    text: str
-    left: int
-    right: int
-    top: int
-    bottom: int
+LANG_EXCHANGE = 'ocr'  # topic exchange, routing key is the tesseract language of the image
+FALLBACK_EXCHANGE = 'ocr_fallback'
+FALLBACK_QUEUE = 'ocr_in'
+TENANT_EXCHANGE = 'ocr_tenant'  # topic exchange, routing key is the tenant of the image
+DEFAULT_TENANT = '*'  # the worker's own queue, images of tenants without a queue
+LANG_PATTERN = re.compile(r'[a-z_]+(\+[a-z_]+)*')  # tesseract language(s), e.g. eng or deu+eng
 
 
 class ServiceBlockingConsumeAPublishB(ABC):
     """Object handling consume and publish of messages. Use it by implementing the
     process_message method in its subclass.
     """
-    def __init__(self, host, queue_a, queue_b, routing_key_b, exchange_a="", exchange_b=""):
+    def __init__(self, host, queue_a, queue_b, routing_key_b, exchange_a="", exchange_b="",
+                 connect_tries=60, probe_port=None, profile_dir=None, profile_seconds=30,
+                 completed_size=100_000, completed_window=3600, completed_path=None, backpressure_max_delay=5,
+                 live_timeout=60):
         """Setup connection, queues, and custom exchanges if used"""
         # TODO add support for other types of exchanges
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host))
+        self.stopping = False
+        self.backpressure_max_delay = backpressure_max_delay
+        self.scheduler: Optional[TenantScheduler] = None
+        self.completed = CompletedMessages(completed_size, completed_window, completed_path)
+        self.timers = SectionTimers()
+        self.profiling = Profiling(profile_dir, profile_seconds)
+        self.probes = serve_probes(probe_port, live_timeout, self.metrics, self.profiling)
+        self.connection = connect(host, connect_tries)
 
         channel_a = self.connection.channel()
         if exchange_a:
             channel_a.exchange_declare(exchange=exchange_a)
-        channel_a.queue_declare(queue=queue_a, durable=True)
+        channel_a.queue_declare(queue=queue_a, durable=True, arguments=queue_arguments(queue_a))
         channel_a.confirm_delivery()
         channel_a.basic_qos(prefetch_count=1)
 
         channel_b = self.connection.channel()
         if exchange_b:
             channel_b.exchange_declare(exchange=exchange_b)
-        channel_b.queue_declare(queue=queue_b, durable=True)
+        channel_b.queue_declare(queue=queue_b, durable=True, arguments=queue_arguments(queue_b))
         channel_b.confirm_delivery()
 
         self.publish_exchange = exchange_b
         self.channel_consume = channel_a
         self.channel_publish = channel_b
         self.consume_queue = queue_a
+        self.current_queue = queue_a  # the queue of the message being processed
         self.publish_routing_key = routing_key_b
 
     @abstractmethod
-    def process_message(self, message: bytes) -> bytes:
+    def process_message(self, message: bytes, headers: Optional[dict] = None) -> bytes:
         """Overwrite with the main service process consuming message and producing the output message"""
         raise NotImplementedError
 
+    def warm_up(self) -> None:
+        """Overwrite to load models and caches before the first message is consumed"""
+
+    def metrics(self) -> dict:
+        """Service statistics served on /metrics"""
+        metrics = dict(sections=self.timers.summary(), duplicates=self.completed.duplicates)
+        if self.scheduler is not None:
+            metrics['tenants'] = self.scheduler.summary()
+        return metrics
+
+    def schedule_tenants(self, queues: dict[str, str], weights: dict[str, int]) -> None:
+        """Pull messages across the tenant: queue map with a TenantScheduler instead of consuming queue a"""
+        self.scheduler = TenantScheduler(queues, weights)
+
+    def get_message(self, queue: str) -> Optional[tuple]:
+        method, properties, body = self.channel_consume.basic_get(queue)
+        return None if method is None else (method, properties, body)
+
+    def messages(self):
+        """Messages to process, consumed from queue a or pulled by the tenant scheduler till stopped.
+        Yields (None, None, None) while idle so the loop keeps its heartbeat.
+        """
+        if self.scheduler is None:
+            yield from self.channel_consume.consume(queue=self.consume_queue, inactivity_timeout=1)
+            return
+        idle = 0.01
+        while not self.stopping:
+            pulled = self.scheduler.next(self.get_message)
+            if pulled is None:
+                self.connection.sleep(idle)  # all tenants empty, back off but keep serving heartbeats
+                idle = min(idle * 2, 0.2)
+                yield None, None, None
+                continue
+            idle = 0.01
+            tenant, (method, properties, body) = pulled
+            self.current_queue = self.scheduler.queues[tenant]
+            yield method, properties, body
+            self.scheduler.done(tenant, properties.headers)
+
+    def stop(self) -> None:
+        """Stop consuming, the run loop returns once the current message is handled"""
+        self.stopping = True
+        self.probes.ready = False
+        self.channel_consume.cancel()
+
+    def publish(self, message: bytes, properties: pika.BasicProperties) -> None:
+        """Publish to queue b. A nack means queue b is full (reject-publish overflow), hold on to the consumed
+        message, which pauses consuming queue a, and retry with exponential backoff till queue b has room.
+        Raises the NackError only when the service is stopping.
+        """
+        delay = 0.1
+        while True:
+            try:
+                with self.timers.section('publish'):
+                    self.channel_publish.basic_publish(
+                        exchange=self.publish_exchange,
+                        routing_key=self.publish_routing_key,
+                        body=message,
+                        properties=properties)
+                return
+            except NackError:
+                if self.stopping:
+                    raise
+                log.warning(f'Published message was not acknowledged, pausing consumption for {delay}s')
+                with self.timers.section('backpressure'):
+                    self.connection.sleep(delay)
+                self.probes.heartbeat()  # throttled, not stuck
+                delay = min(delay * 2, self.backpressure_max_delay)
+
     def run(self) -> None:
         """Start consuming, processing and publishing"""
         # prepare to clean up on interrupt and terminate signal
-        signal.signal(signal.SIGINT, lambda sig, frame: self.channel_consume.cancel())
-        signal.signal(signal.SIGTERM, lambda sig, frame: self.channel_consume.cancel())
+        signal.signal(signal.SIGINT, lambda sig, frame: self.stop())
+        signal.signal(signal.SIGTERM, lambda sig, frame: self.stop())
+        self.profiling.install()
+        self.warm_up()
+        self.probes.ready = True
         # main loop
-        for method, properties, body in self.channel_consume.consume(queue=self.consume_queue):
+        start = time.perf_counter()
+        for method, properties, body in self.messages():
+            self.probes.heartbeat()
+            if method is None:
+                continue
+            self.timers.add('consume', time.perf_counter() - start)
             log.info(f'Consumed message: {properties.correlation_id}')
-            message = self.process_message(body)
+            if self.completed.skip(properties.correlation_id):
+                log.info(f'Message already completed, acknowledging: {properties.correlation_id}')
+                self.channel_consume.basic_ack(delivery_tag=method.delivery_tag)
+                start = time.perf_counter()
+                continue
+            with self.timers.section('process'):
+                message = self.process_message(body, properties.headers)
             confirmation = self.channel_consume.basic_ack
             try:
-                self.channel_publish.basic_publish(
-                    exchange=self.publish_exchange,
-                    routing_key=self.publish_routing_key,
-                    body=message,
-                    properties=pika.BasicProperties(correlation_id=properties.correlation_id))
+                self.publish(message, pika.BasicProperties(correlation_id=properties.correlation_id,
+                                                           headers=properties.headers))
                 log.info(f'Published message: {properties.correlation_id}')
+                self.completed.add(properties.correlation_id)
             except NackError as e:
                 log.warning(f'Published message was not acknowledged. Sending not acknowledge to '
                             f'consumer queue:{e}')
@@ -86,31 +180,287 @@ class ServiceBlockingConsumeAPublishB(ABC):
                             f'consumer queue:{e}')
                 confirmation = self.channel_consume.basic_nack
             finally:
-                confirmation(delivery_tag=method.delivery_tag)
+                with self.timers.section('ack'):
+                    confirmation(delivery_tag=method.delivery_tag)
+            start = time.perf_counter()
+        self.probes.live = False
+
+
+def warm_up_image() -> bytes:
+    """Render a small built-in sample page used to warm up the OCR engine"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new('L', (240, 48), color=255)
+    ImageDraw.Draw(image).text((12, 16), 'Warm up the OCR engine', fill=0)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
 
 
-def detect_text(image: bytes) -> list[TextBoundingBox]:
-    """Load the image in tesseract ocr and extract its data in to TextBoundingBox objects"""
-    trs_data = pytesseract.image_to_data(Image.open(io.BytesIO(image)))
+@dataclass
+class TextRegionStats:
+    """Hit rate of the text region pre-pass"""
+    images: int = 0
+    empty: int = 0  # no candidate regions, tesseract was skipped
+    full_page: int = 0  # candidates covered most of the page, tesseract ran on the whole image
+    many_regions: int = 0  # too many candidates to launch tesseract for each, it ran on the whole image
+    regions: int = 0  # crops sent to tesseract
+    area: float = 0.0  # sum of the page fractions sent to tesseract
+
+    def summary(self) -> dict:
+        images = self.images or 1
+        return dict(asdict(self), skipped_rate=self.empty / images, mean_area=self.area / images)
+
+
+def find_text_regions(image, scale=4, max_side=512, threshold=24, dilate=5, min_cells=3,
+                      margin=4, max_density=0.5) -> list[tuple[int, int, int, int]]:
+    """Cheap pre-pass for detect_text, returns (left, top, right, bottom) page boxes likely to hold text.
+    The page is downsampled by at least `scale` (and to at most `max_side` pixels), edges stronger than
+    `threshold` are dilated so the letters of a line merge and the connected components of the result,
+    grown by `margin` page pixels, are the candidate regions. Components below `min_cells` are noise.
+    A page whose dilated edges cover more than `max_density` of it, e.g. a photo or a texture, is returned as one
+    whole page region without the flood fill.
+    """
+    from PIL import Image, ImageFilter, ImageOps
+
+    gray = image.convert('L')
+    scale = max(scale, -(-max(gray.size) // max_side))
+    width, height = max(1, gray.width // scale), max(1, gray.height // scale)
+    small = gray.resize((width, height), Image.BOX)
+    edges = small.filter(ImageFilter.FIND_EDGES).point(lambda v: 255 if v > threshold else 0)
+    if width > 2 and height > 2:  # the edge filter sees the page border as an edge, drop it
+        edges = ImageOps.expand(edges.crop((1, 1, width - 1, height - 1)), border=1, fill=0)
+    mask = bytearray(edges.filter(ImageFilter.MaxFilter(dilate)).tobytes())
+    if len(mask) - mask.count(0) > max_density * len(mask):
+        return [(0, 0, image.width, image.height)]
+
+    regions = []
+    for seed in range(len(mask)):
+        if not mask[seed]:
+            continue
+        mask[seed] = 0
+        stack = [seed]
+        cells = 0
+        left, top, right, bottom = width, height, 0, 0
+        while stack:
+            i = stack.pop()
+            y, x = divmod(i, width)
+            cells += 1
+            left, right, top, bottom = min(left, x), max(right, x), min(top, y), max(bottom, y)
+            for j in ((i - 1) if x > 0 else -1, (i + 1) if x < width - 1 else -1,
+                      i - width, i + width):
+                if 0 <= j < len(mask) and mask[j]:
+                    mask[j] = 0
+                    stack.append(j)
+        if cells >= min_cells:
+            regions.append((max(0, left * scale - margin), max(0, top * scale - margin),
+                            min(image.width, (right + 1) * scale + margin),
+                            min(image.height, (bottom + 1) * scale + margin)))
+    return merge_regions(regions)
+
+
+def merge_regions(regions: list[tuple[int, int, int, int]]) -> list[tuple[int, int, int, int]]:
+    """Merge overlapping (left, top, right, bottom) boxes so no word is recognised twice"""
+    changed = True
+    while changed:
+        changed = False
+        merged: list[tuple[int, int, int, int]] = []
+        for left, top, right, bottom in regions:
+            for i, (l, t, r, b) in enumerate(merged):
+                if left < r and l < right and top < b and t < bottom:
+                    merged[i] = (min(l, left), min(t, top), max(r, right), max(b, bottom))
+                    changed = True
+                    break
+            else:
+                merged.append((left, top, right, bottom))
+        regions = merged
+    return regions
+
+
+def image_to_boxes(image, left=0, top=0, lang: Optional[str] = None) -> BoxTable:
+    """Run tesseract ocr on a PIL image and offset the words found by (left, top)"""
+    import pytesseract
+
+    trs_data = pytesseract.image_to_data(image, lang=lang)
     csv_reader = csv.reader(io.StringIO(trs_data), delimiter='\t')
     next(csv_reader)  # remove the header
-    return [TextBoundingBox(text=x[11],
-                            left=int(x[6]),
-                            right=int(x[6]) + int(x[8]),  # left + width
-                            top=int(x[7]),
-                            bottom=int(x[7]) + int(x[9])  # top + height
-                            ) for x in csv_reader if int(x[5]) > 0]  # skip non word data
+    words = [x for x in csv_reader if int(x[5]) > 0]  # skip non word data
+    return BoxTable(text=[x[11] for x in words],
+                    left=[left + int(x[6]) for x in words],
+                    right=[left + int(x[6]) + int(x[8]) for x in words],  # left + width
+                    top=[top + int(x[7]) for x in words],
+                    bottom=[top + int(x[7]) + int(x[9]) for x in words])  # top + height
+
+
+def detect_text(image: bytes, text_regions=False, stats: Optional[TextRegionStats] = None,
+                max_coverage=0.6, max_regions=8, lang: Optional[str] = None) -> BoxTable:
+    """Load the image in tesseract ocr and extract its data in to a BoxTable, lang selects the tesseract model.
+    With text_regions the find_text_regions pre-pass runs first: images without candidates return no boxes
+    without calling tesseract and otherwise only the candidate crops are recognised, unless they cover more
+    than max_coverage of the page or there are more than max_regions of them: every crop is a tesseract run
+    of its own, which starts a process and loads the model.
+    """
+    # heavy imports are deferred to the first call (the warm up) to keep the service start fast
+    from PIL import Image
+
+    page = Image.open(io.BytesIO(image))
+    if not text_regions:
+        return image_to_boxes(page, lang=lang)
+    stats = stats or TextRegionStats()
+    stats.images += 1
+    regions = find_text_regions(page)
+    if not regions:
+        stats.empty += 1
+        return BoxTable()
+    if len(regions) > max_regions:
+        stats.many_regions += 1
+        stats.area += 1
+        return image_to_boxes(page, lang=lang)
+    coverage = sum((r - l) * (b - t) for l, t, r, b in regions) / (page.width * page.height)
+    if coverage > max_coverage:
+        stats.full_page += 1
+        stats.area += 1
+        return image_to_boxes(page, lang=lang)
+    stats.regions += len(regions)
+    stats.area += coverage
+    return BoxTable.concat(image_to_boxes(page.crop((left, top, right, bottom)), left, top, lang)
+                           for left, top, right, bottom in regions)
+
+
+def message_language(headers: Optional[dict]) -> Optional[str]:
+    """Tesseract language from the `lang` message header, None (the default model) if missing or invalid"""
+    lang = (headers or {}).get('lang')
+    if isinstance(lang, bytes):
+        lang = lang.decode()
+    if isinstance(lang, str) and LANG_PATTERN.fullmatch(lang):
+        return lang
+    return None
+
+
+class TesseractLanguages:
+    """The tesseract models installed, read once at warm up, and the messages asking for a missing one"""
+    def __init__(self):
+        self.installed: Optional[set[str]] = None
+        self.missing: dict[str, int] = {}  # language: messages
+
+    def load(self) -> None:
+        import pytesseract
+
+        self.installed = set(pytesseract.get_languages(config=''))
+        log.info(f'Tesseract models installed: {sorted(self.installed)}')
+
+    def resolve(self, lang: Optional[str]) -> Optional[str]:
+        """lang if all of its models are installed, otherwise None (the default model) counting the miss"""
+        if lang is None or self.installed is None or set(lang.split('+')) <= self.installed:
+            return lang
+        self.missing[lang] = self.missing.get(lang, 0) + 1
+        log.warning(f'No tesseract model for {lang} installed, recognising the image with the default model')
+        return None
+
+
+def declare_language_routing(channel, queue: str, lang: Optional[str] = None) -> None:
+    """Route images by language. Producers publish to the LANG_EXCHANGE with the image language as routing key
+    (and `lang` header), a worker keeping a model warm advertises it by binding its lane queue, e.g. ocr_in.deu,
+    with that key. Languages without a lane reach the FALLBACK_QUEUE through the alternate exchange, as do lane
+    messages not consumed in time (see common.queues.LANE_FALLBACK). Publishing straight to ocr_in still works.
+    """
+    channel.exchange_declare(exchange=FALLBACK_EXCHANGE, exchange_type='fanout', durable=True)
+    channel.queue_declare(queue=FALLBACK_QUEUE, durable=True, arguments=queue_arguments(FALLBACK_QUEUE))
+    channel.queue_bind(queue=FALLBACK_QUEUE, exchange=FALLBACK_EXCHANGE)
+    channel.exchange_declare(exchange=LANG_EXCHANGE, exchange_type='topic', durable=True,
+                             arguments={'alternate-exchange': FALLBACK_EXCHANGE})
+    if lang:
+        channel.queue_bind(queue=queue, exchange=LANG_EXCHANGE, routing_key=lang)
+
+
+def release_language_lane(channel, queue: str, lang: str) -> bool:
+    """Unbind the lane of a stopping worker if no other worker consumes it, so new images of its language fall
+    through to the FALLBACK_QUEUE right away instead of waiting out the lane ttl, the backlog left in the lane is
+    still dead lettered there. Returns True if the lane was unbound.
+    """
+    if channel.queue_declare(queue=queue, durable=True, passive=True).method.consumer_count:
+        return False
+    channel.queue_unbind(queue=queue, exchange=LANG_EXCHANGE, routing_key=lang)
+    log.info(f'Released the {lang} lane, its images fall back to {FALLBACK_QUEUE}')
+    return True
+
+
+def declare_tenant_routing(channel, queue: str, tenants: dict[str, int]) -> dict[str, str]:
+    """Give each tenant its own queue, ocr_tenant.<tenant>, fed by the TENANT_EXCHANGE with the tenant as routing
+    key. Images of other tenants fall through to the FALLBACK_QUEUE. Returns the tenant: queue map to schedule,
+    where the worker's own queue is the DEFAULT_TENANT.
+    """
+    channel.exchange_declare(exchange=TENANT_EXCHANGE, exchange_type='topic', durable=True,
+                             arguments={'alternate-exchange': FALLBACK_EXCHANGE})
+    queues = {DEFAULT_TENANT: queue}
+    for tenant in tenants:
+        if tenant == DEFAULT_TENANT:
+            continue
+        queues[tenant] = f'{TENANT_EXCHANGE}.{tenant}'
+        channel.queue_declare(queue=queues[tenant], durable=True, arguments=queue_arguments(queues[tenant]))
+        channel.queue_bind(queue=queues[tenant], exchange=TENANT_EXCHANGE, routing_key=tenant)
+    return queues
 
 
 class ServiceOCR(ServiceBlockingConsumeAPublishB):
-    def process_message(self, message: bytes) -> bytes:
+    def __init__(self, *args, lang=None, text_regions=False, tenants=None, **kwargs):
+        """lang is the tesseract model this worker keeps warm and the language lane it consumes, without it the
+        worker consumes the fallback lane using the language of each message. Tenant queues hold images of any
+        language, their messages are recognised with the language of the message as well.
+        text_regions switches on the find_text_regions pre-pass of detect_text.
+        tenants maps tenants to their weight, the worker then serves their queues and its own (weight of the
+        DEFAULT_TENANT) with weighted deficit round robin.
+        """
+        self.lang = lang
+        self.text_regions = text_regions
+        self.region_stats = TextRegionStats()
+        self.languages = TesseractLanguages()
+        super().__init__(*args, **kwargs)
+        declare_language_routing(self.channel_consume, self.consume_queue, lang)
+        if tenants:
+            queues = declare_tenant_routing(self.channel_consume, self.consume_queue, tenants)
+            self.schedule_tenants(queues, tenants)
+
+    def metrics(self) -> dict:
+        return dict(super().metrics(), text_regions=self.region_stats.summary(),
+                    missing_languages=self.languages.missing)
+
+    def run(self) -> None:
+        super().run()
+        # workers pulling with the tenant scheduler do not show up as consumers, they can not tell who is left
+        if self.lang and self.scheduler is None:
+            release_language_lane(self.channel_consume, self.consume_queue, self.lang)
+
+    def warm_up(self) -> None:
+        """Run the OCR on a sample image so the first message does not pay for imports and model loading"""
+        detect_text(warm_up_image(), lang=self.lang)
+        self.languages.load()
+        log.info(f'OCR engine warmed up for {self.lang or "the default language"}')
+
+    def process_message(self, message: bytes, headers: Optional[dict] = None) -> bytes:
         """Pop the image from the message and replace it with the text recognised."""
-        return json.dumps([asdict(x) for x in detect_text(message)]).encode()
+        with self.timers.section('ocr'):
+            if self.lang and self.current_queue == self.consume_queue:
+                lang = self.lang
+            else:
+                lang = self.languages.resolve(message_language(headers))
+            boxes = detect_text(message, self.text_regions, self.region_stats, lang=lang)
+        with self.timers.section('encode'):
+            return json.dumps(boxes.to_records()).encode()
 
 
 if __name__ == '__main__':
+    lang = os.environ.get('OCR_LANG')
     service = ServiceOCR(host=os.environ.get('RABBITMQ_HOST'),
-                         queue_a='ocr_in',
+                         lang=lang,
+                         queue_a=f'{FALLBACK_QUEUE}.{lang}' if lang else FALLBACK_QUEUE,
                          queue_b='ocr_out',
-                         routing_key_b='ocr_out')
+                         routing_key_b='ocr_out',
+                         probe_port=os.environ.get('PROBE_PORT'),
+                         profile_dir=os.environ.get('PROFILE_DIR'),
+                         profile_seconds=os.environ.get('PROFILE_SECONDS', 30),
+                         completed_path=os.environ.get('COMPLETED_PATH'),
+                         live_timeout=os.environ.get('LIVE_TIMEOUT', 60),
+                         text_regions=os.environ.get('OCR_TEXT_REGIONS', '') in ('1', 'true'),
+                         tenants=parse_tenants(os.environ.get('OCR_TENANTS')))
     service.run()
@@ -4,39 +4,40 @@ import json
 import time
 import signal
 import logging
-from dataclasses import asdict, dataclass
-from pika.exceptions import NackError, UnroutableError
+from typing import Optional
+from pika.exceptions import ChannelClosedByBroker, NackError, UnroutableError
 from abc import ABC, abstractmethod
+from common.boxes import BoxTable
+from common.idempotency import CompletedMessages
+from common.queues import FANOUT_BOUND, FANOUT_HEADROOM, QUEUE_LIMITS, queue_arguments
+from common.service import connect, serve_probes
+from common.profiling import Profiling, SectionTimers
 
 log = logging.getLogger(__name__)
 
 
-@dataclass(order=True)
-class TextBoundingBox:
-    """Pillow-type Bound Box.
-    Co-ordinates start in (0,0) in the Top Left Corner.
-    """
-    text: str
-    left: int
-    right: int
-    top: int
-    bottom: int
-
-
 class ServiceBlockingConsumeABPublishC(ABC):
     """Object handling consume and publish of messages. Use it by implementing the
     process_message method in its subclass.
     """
     def __init__(self, host, buffer, queue_a,
-                 exchange_b, exchange_c):
+                 exchange_b, exchange_c, connect_tries=60, probe_port=None, profile_dir=None,
+                 profile_seconds=30, completed_size=100_000, completed_window=3600, completed_path=None,
+                 backpressure_max_delay=5, live_timeout=60):
         """Setup connection, queues, and custom exchanges if used"""
+        self.stopping = False
+        self.backpressure_max_delay = backpressure_max_delay
         self.unresolved_buffer = buffer  # must be grater than the number of ocr replicas
         self.publish_exchange = exchange_c
+        self.completed = CompletedMessages(completed_size, completed_window, completed_path)
+        self.timers = SectionTimers()
+        self.profiling = Profiling(profile_dir, profile_seconds)
+        self.probes = serve_probes(probe_port, live_timeout, self.metrics, self.profiling)
 
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host))
+        self.connection = connect(host, connect_tries)
 
         channel_a = self.connection.channel()
-        channel_a.queue_declare(queue=queue_a, durable=True)
+        channel_a.queue_declare(queue=queue_a, durable=True, arguments=queue_arguments(queue_a))
         channel_a.basic_qos(prefetch_count=1)
         self.channel_consume_priority = channel_a
         self.consume_queue_priority = queue_a
@@ -55,6 +56,10 @@ class ServiceBlockingConsumeABPublishC(ABC):
         channel_c_publish.queue_declare(queue="", durable=True)
         channel_c_publish.confirm_delivery()
         self.channel_publish = channel_c_publish
+        self.room_queues = FANOUT_BOUND.get(exchange_c, [])
+        self.channel_room = self.connection.channel()
+        self.room_checked = -1.0
+        self.rejected = 0
 
         channel_c_consume = self.connection.channel()
         if exchange_c:
@@ -68,10 +73,25 @@ class ServiceBlockingConsumeABPublishC(ABC):
         self.resolved_match_messages = set()  # pii messages processed by replicas
 
     @abstractmethod
-    def process_message(self, message_a: bytes, message_b: bytes) -> bytes:
+    def process_message(self, message_a: bytes, message_b: bytes, headers: Optional[dict] = None) -> bytes:
         """Overwrite with the main service process consuming message and producing the output message"""
         raise NotImplementedError
 
+    def warm_up(self) -> None:
+        """Overwrite to load models and caches before the first message is consumed"""
+
+    def metrics(self) -> dict:
+        """Service statistics served on /metrics"""
+        return dict(sections=self.timers.summary(), duplicates=self.completed.duplicates,
+                    unresolved_match_messages=len(self.unresolved_match_messages),
+                    resolved_match_messages=len(self.resolved_match_messages), rejected=self.rejected)
+
+    def stop(self) -> None:
+        """Stop consuming, the run loop returns once the current message is handled"""
+        self.stopping = True
+        self.probes.ready = False
+        self.channel_consume_priority.cancel()
+
     def wait_queue_match_message(self):
         while True:
             queue_state = self.channel_consume_match.queue_declare(
@@ -104,54 +124,130 @@ class ServiceBlockingConsumeABPublishC(ABC):
         while self.channel_c_consume.queue_declare(queue=self.consume_queue_match_resolved, durable=True,
                                                    exclusive=True, passive=True).method.message_count > 0:
             method, properties, body = self.channel_c_consume.basic_get(self.consume_queue_match_resolved)
+            self.completed.add(properties.correlation_id)  # results of all replicas pass here
             if properties.correlation_id in self.unresolved_match_messages:
                 self.unresolved_match_messages.pop(properties.correlation_id)
             else:
                 self.resolved_match_messages.add(properties.correlation_id)
             self.channel_c_consume.basic_ack(delivery_tag=method.delivery_tag)
 
+    def has_room(self) -> bool:
+        """False while a bounded queue bound to exchange c holds FANOUT_HEADROOM of its length limit"""
+        for queue in self.room_queues:
+            try:
+                count = self.channel_room.queue_declare(queue=queue, passive=True).method.message_count
+            except ChannelClosedByBroker:  # not declared, e.g. no sink deployed, the broker closed the channel
+                self.channel_room = self.connection.channel()
+                continue
+            if count >= QUEUE_LIMITS[queue]['max_length'] * FANOUT_HEADROOM:
+                return False
+        return True
+
+    def wait_for_room(self) -> bool:
+        """Hold on to the consumed message, which pauses consuming queue a, and back off exponentially while a
+        bounded queue bound to exchange c is nearly full. While there is room it is checked once a second.
+        Returns False if the service is stopping before there is room.
+        """
+        if not self.room_queues or time.monotonic() - self.room_checked < 1:
+            return True
+        delay = 0.1
+        while not self.has_room():
+            if self.stopping:
+                return False
+            log.warning(f'A queue bound to {self.publish_exchange} is nearly full, pausing consumption for {delay}s')
+            with self.timers.section('backpressure'):
+                self.connection.sleep(delay)
+            self.probes.heartbeat()  # throttled, not stuck
+            delay = min(delay * 2, self.backpressure_max_delay)
+        self.room_checked = time.monotonic()
+        return True
+
+    def publish(self, message: bytes, properties: pika.BasicProperties) -> bool:
+        """Publish to exchange c once. It fans out and a publish nacked by one full queue (reject-publish overflow)
+        already reached the other bound queues, a retry would duplicate it there. So wait_for_room pauses before
+        publishing and a nack, the queue filled up regardless (e.g. by its byte limit), is counted as rejected.
+        Returns False if the message was not published because the service is stopping.
+        """
+        if not self.wait_for_room():
+            return False
+        try:
+            with self.timers.section('publish'):
+                self.channel_publish.basic_publish(
+                    exchange=self.publish_exchange,
+                    routing_key="",
+                    body=message,
+                    properties=properties)
+        except NackError:
+            self.rejected += 1
+            log.error(f'Published message was rejected by a full queue bound to {self.publish_exchange}, '
+                      f'not retried to not duplicate it: {properties.correlation_id}')
+        return True
+
     def run(self):
         """Main loop consuming, processing and publishing"""
-        signal.signal(signal.SIGINT, lambda sig, frame: self.channel_consume_priority.cancel())
-        signal.signal(signal.SIGTERM, lambda sig, frame: self.channel_consume_priority.cancel())
+        signal.signal(signal.SIGINT, lambda sig, frame: self.stop())
+        signal.signal(signal.SIGTERM, lambda sig, frame: self.stop())
+        self.profiling.install()
+        self.warm_up()
+        self.probes.ready = True
         # main loop
-        for method, properties, body in self.channel_consume_priority.consume(queue=self.consume_queue_priority):
+        start = time.perf_counter()
+        for method, properties, body in self.channel_consume_priority.consume(queue=self.consume_queue_priority,
+                                                                              inactivity_timeout=1):
+            self.probes.heartbeat()
+            if method is None:
+                continue
+            self.timers.add('consume', time.perf_counter() - start)
             log.info(f'Consumed priority message: {properties.correlation_id}')
-            message = self.process_message(message_a=body,
-                                           message_b=self.get_message_with(properties.correlation_id))
+            if self.completed.skip(properties.correlation_id):
+                log.info(f'Message already completed, acknowledging: {properties.correlation_id}')
+                self.channel_consume_priority.basic_ack(delivery_tag=method.delivery_tag)
+                start = time.perf_counter()
+                continue
+            with self.timers.section('join'):
+                message_b = self.get_message_with(properties.correlation_id)
+            with self.timers.section('process'):
+                message = self.process_message(message_a=body, message_b=message_b, headers=properties.headers)
             confirmation_priority = self.channel_consume_priority.basic_ack
             try:
-                self.channel_publish.basic_publish(
-                    exchange=self.publish_exchange,
-                    routing_key="",
-                    body=message,
-                    properties=pika.BasicProperties(correlation_id=properties.correlation_id))
-                log.info(f'Published message: {properties.correlation_id}')
-            except NackError as e:
-                log.warning(f'Published message was not acknowledged. Sending not acknowledge to '
-                            f'consumer queue:{e}')
-                confirmation_priority = self.channel_consume_priority.basic_nack
+                if self.publish(message, pika.BasicProperties(correlation_id=properties.correlation_id,
+                                                              headers=properties.headers)):
+                    log.info(f'Published message: {properties.correlation_id}')
+                    self.completed.add(properties.correlation_id)
+                else:
+                    log.warning(f'Stopped before the message was published. Sending not acknowledge to '
+                                f'consumer queue: {properties.correlation_id}')
+                    confirmation_priority = self.channel_consume_priority.basic_nack
             except UnroutableError as e:
                 log.warning(f'Published message was not routed. Sending not acknowledged to '
                             f'consumer queue:{e}')
                 confirmation_priority = self.channel_consume_priority.basic_nack
             finally:
-                confirmation_priority(delivery_tag=method.delivery_tag)
-                self.clean_unresolved()
+                with self.timers.section('ack'):
+                    confirmation_priority(delivery_tag=method.delivery_tag)
+                with self.timers.section('clean'):
+                    self.clean_unresolved()
+            start = time.perf_counter()
+        self.probes.live = False
 
 
-def filter_to_pii(bounding_boxes: list[TextBoundingBox], pii: list[str]) -> list[TextBoundingBox]:
+def filter_to_pii(bounding_boxes: BoxTable, pii: list[str]) -> BoxTable:
     """Filter bounding boxes that contain pii"""
-    return [x for x in bounding_boxes if x.text.lower() not in pii]
+    pii = set(pii)  # constant time lookups, the lists can hold many terms
+    return bounding_boxes.mask([x not in pii for x in bounding_boxes.text_lower])
 
 
 class ServiceFilter(ServiceBlockingConsumeABPublishC):
     """Process ocr_out messages"""
-    def process_message(self, message_a: bytes, message_b: bytes) -> bytes:
+    def process_message(self, message_a: bytes, message_b: bytes, headers: Optional[dict] = None) -> bytes:
         """Handle unpacking messages, call filter_to_pii, and return packed message"""
-        boxes = [TextBoundingBox(**x) for x in json.loads(message_a.decode())]
-        pii_texts = json.loads(message_b.decode())
-        return json.dumps([asdict(x) for x in filter_to_pii(boxes, pii_texts)]).encode()
+        with self.timers.section('decode'):
+            boxes = BoxTable.from_records(json.loads(message_a.decode()))
+            pii_texts = json.loads(message_b.decode())
+        with self.timers.section('filter'):
+            boxes = filter_to_pii(boxes, pii_texts)
+        with self.timers.section('encode'):
+            return json.dumps(boxes.to_records()).encode()
 
 
 if __name__ == '__main__':
@@ -159,5 +255,10 @@ if __name__ == '__main__':
                             buffer=15,
                             queue_a='ocr_out',
                             exchange_b='pii',
-                            exchange_c='pii_out')
+                            exchange_c='pii_out',
+                            probe_port=os.environ.get('PROBE_PORT'),
+                            profile_dir=os.environ.get('PROFILE_DIR'),
+                            profile_seconds=os.environ.get('PROFILE_SECONDS', 30),
+                            completed_path=os.environ.get('COMPLETED_PATH'),
+                            live_timeout=os.environ.get('LIVE_TIMEOUT', 60))
     service.run()
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import signal
+import struct
+import logging
+from typing import Optional
+from common.queues import queue_arguments
+from common.service import connect, serve_probes
+from common.profiling import SectionTimers
+
+log = logging.getLogger(__name__)
+
+BINARY_HEADER = struct.Struct('<HI')  # correlation id length, body length
+
+
+class SegmentWriter:
+    """Append only store of result messages in rotating segment files.
+    Records are buffered by append and written by flush, which fsyncs before returning, so a message can be
+    acknowledged once the flush covering it returned. The `jsonl` format writes one
+    {"correlation_id": ..., "boxes": [...]} line per message, reusing the message body without decoding it,
+    the `binary` format writes BINARY_HEADER followed by the correlation id and body bytes. A message without
+    correlation id is stored with a null (jsonl) or empty (binary) one.
+    With `index` a correlation_id: (segment, offset) map is kept for lookup and persisted next to the segments,
+    messages without correlation id are not indexed. A crash during flush can leave a half written record at the
+    end of the last segment or index, it is cut off when the writer is opened again, before the unacknowledged
+    batch is redelivered and appended.
+    """
+    def __init__(self, directory: str, segment_bytes: int = 64 << 20, binary: bool = False, index: bool = False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.binary = binary
+        self.suffix = 'bin' if binary else 'jsonl'
+        self.buffer: list[tuple[Optional[str], bytes]] = []
+        self.index: Optional[dict[str, tuple[int, int]]] = None
+        self.index_file = None
+        if index:
+            self.index = {}
+            index_path = os.path.join(directory, 'index.jsonl')
+            if os.path.exists(index_path):
+                with open(index_path, 'rb') as fh:
+                    data = fh.read()
+                length = data.rfind(b'\n') + 1
+                self.truncate(index_path, data, length)
+                self.index.update((x[0], (x[1], x[2])) for x in map(json.loads, data[:length].splitlines()))
+            self.index_file = open(index_path, 'a')
+        segments = sorted(int(x.split('.')[0].split('-')[1]) for x in os.listdir(directory)
+                          if x.startswith('segment-') and x.endswith(self.suffix))
+        self.segment = segments[-1] if segments else 0
+        if segments:
+            with open(self.segment_path(self.segment), 'rb') as fh:
+                data = fh.read()
+            self.truncate(self.segment_path(self.segment), data, self.complete_length(data))
+        self.file = open(self.segment_path(self.segment), 'ab')
+
+    def complete_length(self, data: bytes) -> int:
+        """Length of the complete records at the start of the segment data"""
+        if not self.binary:
+            return data.rfind(b'\n') + 1
+        end = 0
+        while end + BINARY_HEADER.size <= len(data):
+            cid_length, body_length = BINARY_HEADER.unpack_from(data, end)
+            if end + BINARY_HEADER.size + cid_length + body_length > len(data):
+                break
+            end += BINARY_HEADER.size + cid_length + body_length
+        return end
+
+    @staticmethod
+    def truncate(path: str, data: bytes, length: int) -> None:
+        if length < len(data):
+            log.warning(f'Cutting a torn record of {len(data) - length} bytes off {path}')
+            with open(path, 'r+b') as fh:
+                fh.truncate(length)
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'segment-{segment:06d}.{self.suffix}')
+
+    def encode(self, correlation_id: Optional[str], body: bytes) -> bytes:
+        if self.binary:
+            cid = (correlation_id or '').encode()
+            return BINARY_HEADER.pack(len(cid), len(body)) + cid + body
+        return b'{"correlation_id": %s, "boxes": %s}\n' % (json.dumps(correlation_id).encode(), body)
+
+    def append(self, correlation_id: Optional[str], body: bytes) -> None:
+        self.buffer.append((correlation_id, body))
+
+    def flush(self) -> None:
+        """Write the buffered records in one batch and fsync them (and the index) to disk"""
+        if not self.buffer:
+            return
+        if self.file.tell() >= self.segment_bytes:
+            self.file.close()
+            self.segment += 1
+            self.file = open(self.segment_path(self.segment), 'ab')
+        offset = self.file.tell()
+        records = []
+        index = []
+        for correlation_id, body in self.buffer:
+            record = self.encode(correlation_id, body)
+            records.append(record)
+            if self.index is not None and correlation_id is not None:
+                self.index[correlation_id] = (self.segment, offset)
+                index.append(json.dumps([correlation_id, self.segment, offset]) + '\n')
+            offset += len(record)
+        self.file.write(b''.join(records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.index_file is not None:
+            self.index_file.write(''.join(index))
+            self.index_file.flush()
+            os.fsync(self.index_file.fileno())
+        self.buffer.clear()
+
+    def lookup(self, correlation_id: str) -> Optional[bytes]:
+        """Message body stored for the correlation id, needs the index"""
+        if self.index is None:
+            raise ValueError('SegmentWriter was created without an index')
+        if correlation_id not in self.index:
+            return None
+        segment, offset = self.index[correlation_id]
+        with open(self.segment_path(segment), 'rb') as fh:
+            fh.seek(offset)
+            if self.binary:
+                cid_length, body_length = BINARY_HEADER.unpack(fh.read(BINARY_HEADER.size))
+                fh.seek(cid_length, os.SEEK_CUR)
+                return fh.read(body_length)
+            return json.dumps(json.loads(fh.readline())['boxes']).encode()
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+
+class ServiceSink:
+    """Drain the results published to a fanout exchange into a SegmentWriter.
+    Prefetches `batch` messages, writes them in one fsync'd flush and then acknowledges them all with a
+    single multiple ack. A partial batch is flushed once its oldest message waited `flush_interval` seconds,
+    so a steady trickle below the batch size is not held back till the batch fills.
+    Drain rate and end to end latency (from the `ingest_ts` header set by the publishers) are served on
+    /metrics and logged every `report_interval` seconds.
+    """
+    def __init__(self, host, exchange, queue, writer: SegmentWriter, batch=500, flush_interval=0.2,
+                 report_interval=10, connect_tries=60, probe_port=None, live_timeout=60):
+        self.writer = writer
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.report_interval = report_interval
+        self.timers = SectionTimers()
+        self.drained = 0
+        self.latency: list[float] = [0, 0.0, 0.0]  # count, total, max seconds
+        self.started = time.time()
+        self.probes = serve_probes(probe_port, live_timeout, self.metrics)
+        self.connection = connect(host, connect_tries)
+        channel = self.connection.channel()
+        channel.exchange_declare(exchange=exchange, exchange_type='fanout')
+        channel.queue_declare(queue=queue, durable=True, arguments=queue_arguments(queue))
+        channel.queue_bind(exchange=exchange, queue=queue)
+        channel.basic_qos(prefetch_count=2 * batch)  # keep the next batch in flight while flushing
+        self.channel = channel
+        self.queue = queue
+
+    def metrics(self) -> dict:
+        count, total, max_ = self.latency
+        elapsed = time.time() - self.started
+        return dict(sections=self.timers.summary(), drained=self.drained, rate=self.drained / elapsed,
+                    latency=dict(count=count, mean=total / count if count else 0.0, max=max_))
+
+    def record_latency(self, properties) -> None:
+        ingest_ts = (properties.headers or {}).get('ingest_ts')
+        if ingest_ts is not None:
+            latency = time.time() - ingest_ts
+            self.latency[0] += 1
+            self.latency[1] += latency
+            self.latency[2] = max(self.latency[2], latency)
+
+    def flush(self, delivery_tag) -> None:
+        with self.timers.section('flush'):
+            self.writer.flush()
+        with self.timers.section('ack'):
+            self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+
+    def stop(self) -> None:
+        self.probes.ready = False
+        self.channel.cancel()
+
+    def run(self) -> None:
+        """Consume, write and acknowledge in batches till stopped"""
+        signal.signal(signal.SIGINT, lambda sig, frame: self.stop())
+        signal.signal(signal.SIGTERM, lambda sig, frame: self.stop())
+        self.probes.ready = True
+        pending, last_tag, oldest = 0, None, 0.0
+        reported = time.time()
+        messages = self.channel.consume(queue=self.queue, inactivity_timeout=self.flush_interval)
+        for method, properties, body in messages:
+            self.probes.heartbeat()
+            if method is not None:
+                self.writer.append(properties.correlation_id, body)
+                self.record_latency(properties)
+                if not pending:
+                    oldest = time.monotonic()
+                pending, last_tag = pending + 1, method.delivery_tag
+            if pending and (pending >= self.batch or time.monotonic() - oldest >= self.flush_interval):
+                self.flush(last_tag)
+                self.drained += pending
+                pending = 0
+            if time.time() - reported >= self.report_interval:
+                reported = time.time()
+                log.info(f'Sink metrics: {self.metrics()}')
+        if pending:
+            self.flush(last_tag)
+            self.drained += pending
+        self.writer.close()
+        self.probes.live = False
+
+
+if __name__ == '__main__':
+    service = ServiceSink(host=os.environ.get('RABBITMQ_HOST'),
+                          exchange='pii_out',
+                          queue='pii_sink',
+                          writer=SegmentWriter(os.environ.get('SINK_DIR', '/data'),
+                                               binary=os.environ.get('SINK_FORMAT') == 'binary',
+                                               index=os.environ.get('SINK_INDEX', '') in ('1', 'true')),
+                          probe_port=os.environ.get('PROBE_PORT'),
+                          live_timeout=os.environ.get('LIVE_TIMEOUT', 60))
+    service.run()
@@ -5,6 +5,7 @@
 import logging
 import pika
 from pika.exchange_type import ExchangeType
+from common.queues import queue_arguments
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -194,6 +195,7 @@ class RMQPublisher(object):
         LOGGER.info('Declaring queue %s', queue_name)
         self._channel.queue_declare(queue=queue_name,
                                     durable=True,
+                                    arguments=queue_arguments(queue_name),
                                     callback=self.on_queue_declareok)
 
     def on_queue_declareok(self, _unused_frame):
@@ -1,8 +1,10 @@
+import time
 import pika
 import logging
 from retry import retry
 from pika.exceptions import NackError, UnroutableError
 from pika.exchange_type import ExchangeType
+from common.queues import queue_arguments
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -29,7 +31,7 @@ class RMQPublisher:
 
     @retry(pika.exceptions.NackError, delay=5, jitter=(1, 3))
     def publish(self, routing_key: str, message: bytes, correlation_id=None):
-        properties = pika.BasicProperties(correlation_id=correlation_id) if correlation_id else None
+        properties = pika.BasicProperties(correlation_id=correlation_id, headers=dict(ingest_ts=time.time()))
         self.channel.basic_publish(
             exchange=self.exchange,
             routing_key=routing_key,
@@ -39,7 +41,7 @@ class RMQPublisher:
 
     def publish_messages(self, queue: str, messages: list):
         self.connect()
-        self.channel.queue_declare(queue=queue, durable=True)
+        self.channel.queue_declare(queue=queue, durable=True, arguments=queue_arguments(queue))
         for uuid, message in messages:
             self.publish(routing_key=queue, message=message, correlation_id=uuid)
         self.channel.close()
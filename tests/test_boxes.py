@@ -0,0 +1,45 @@
+import pytest
+from common.boxes import BoxTable, TextBoundingBox
+
+
+@pytest.fixture
+def table():
+    # two lines of text, given out of reading order
+    return BoxTable.from_boxes([
+        TextBoundingBox('world', 60, 110, 12, 30),
+        TextBoundingBox('Hello', 10, 50, 10, 30),
+        TextBoundingBox('again', 10, 60, 50, 70),
+    ])
+
+
+def test_records_round_trip(table):
+    assert BoxTable.from_records(table.to_records()) == table
+    assert table.to_records()[1] == dict(text='Hello', left=10, right=50, top=10, bottom=30)
+    assert table[1] == TextBoundingBox('Hello', 10, 50, 10, 30)
+    assert len(table) == 3
+
+
+def test_columns_must_match():
+    with pytest.raises(ValueError):
+        BoxTable(['a'], [1], [2], [3], [])
+
+
+def test_mask_take_concat(table):
+    assert [x.text for x in table.mask([True, False, True])] == ['world', 'again']
+    assert [x.text for x in table.take([2, 0])] == ['again', 'world']
+    assert BoxTable.concat([table.take([0]), table.take([1, 2])]) == table
+    assert table.text_lower == ['world', 'hello', 'again']
+
+
+def test_reading_order(table):
+    assert table.lines() == [[1, 0], [2]]
+    assert [x.text for x in table.reading_order()] == ['Hello', 'world', 'again']
+
+
+def test_grid_index(table):
+    index = table.index(cell=16)
+    assert index.query(0, 0, 200, 40) == [0, 1]
+    assert index.query(0, 0, 100, 40, inside=True) == [1]
+    assert index.query(200, 200, 300, 300) == []
+    assert index.near(1, margin=10) == [0]
+    assert index.near(1, margin=25) == [0, 2]
@@ -0,0 +1,26 @@
+from common.idempotency import CompletedMessages
+
+
+def test_completed_messages(mocker):
+    now = mocker.patch('time.time', return_value=1000.0)
+    completed = CompletedMessages(size=2, window=60)
+    completed.add('a')
+    completed.add('b')
+    assert 'a' in completed and 'b' in completed and 'c' not in completed and None not in completed
+    completed.add('c')  # evicts the oldest
+    assert 'a' not in completed
+    now.return_value = 1061.0  # out of the window
+    assert 'c' not in completed
+    assert not completed.skip('c')
+    completed.add('c')
+    assert completed.skip('c')
+    assert completed.duplicates == 1
+
+
+def test_completed_messages_shared_on_disk(tmp_path):
+    path = str(tmp_path / 'completed.sqlite')
+    replica_1 = CompletedMessages(path=path)
+    replica_2 = CompletedMessages(path=path)
+    replica_1.add('a')
+    assert 'a' in replica_2
+    assert 'b' not in replica_2
@@ -1,19 +1,36 @@
 import json
-import time
 
 import pika
 import pytest
+from pika.exceptions import AMQPConnectionError, ChannelClosedByBroker
 from uuid import uuid4
 from pathlib import Path
 from .sync_publisher import RMQPublisher
 
 
+def pipeline_ready(host: str, port: int) -> bool:
+    """True once RabbitMQ accepts connections and the OCR and filter services consume their input queues,
+    the services only start consuming once they are ready"""
+    try:
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port))
+    except AMQPConnectionError:
+        return False
+    try:
+        channel = connection.channel()
+        return all(channel.queue_declare(queue=queue, passive=True).method.consumer_count
+                   for queue in ('ocr_in', 'ocr_out'))
+    except ChannelClosedByBroker:  # not declared yet
+        return False
+    finally:
+        connection.close()
+
+
 @pytest.fixture(scope="session")
 def compose(docker_ip, docker_services):
     """Builds and runs Docker Compose services and yields pika interface."""
     attempts = 3
     port = docker_services.port_for("rabbitmq", 5672)
-    time.sleep(30)
+    docker_services.wait_until_responsive(check=lambda: pipeline_ready(docker_ip, port), timeout=90, pause=0.5)
     yield f"amqp://guest:guest@{docker_ip}:{port}/%2F?connection_attempts={attempts}&heartbeat=3600"
 
 
@@ -0,0 +1,23 @@
+from ocr_filter import run as dut
+from common.boxes import BoxTable, TextBoundingBox
+
+
+class TestServiceOCRFilter:
+    def test_process_message(self, mocker):
+        mocker.patch.object(dut, 'detect_text', return_value=BoxTable.from_boxes([
+            TextBoundingBox('Alice', 1, 2, 3, 4), TextBoundingBox('kitten', 5, 6, 7, 8)]))
+        mocker.patch('pii_filter.run.connect')
+        service = dut.ServiceOCRFilter('host', 15, 'a', 'b', 'c')
+        out = service.process_message(b'', dut.json.dumps(['alice']).encode())
+        assert isinstance(out, bytes)
+        assert dut.json.loads(out.decode()) == [dict(text='kitten', left=5, right=6, top=7, bottom=8)]
+
+    def test_missing_language_uses_default_model(self, mocker):
+        detect_text = mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        mocker.patch('pytesseract.get_languages', return_value=['eng'])
+        mocker.patch('pii_filter.run.connect')
+        service = dut.ServiceOCRFilter('host', 15, 'a', 'b', 'c')
+        service.warm_up()
+        service.process_message(b'', b'[]', dict(lang='deu+eng'))
+        assert detect_text.call_args.kwargs['lang'] is None
+        assert service.metrics()['missing_languages'] == {'deu+eng': 1}
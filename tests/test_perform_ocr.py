@@ -1,5 +1,13 @@
 import pytest
+from PIL import Image, ImageDraw
 from perform_ocr import run as dut
+from common.boxes import BoxTable, TextBoundingBox
+
+
+@pytest.fixture(autouse=True)
+def tesseract_models(mocker):
+    """Models the services list at warm up, the tests needing tesseract itself run it for real"""
+    return mocker.patch('pytesseract.get_languages', return_value=['deu', 'eng', 'fra', 'osd'])
 
 
 @pytest.mark.parametrize('img_path, ref', [
@@ -12,13 +20,184 @@ def test_detect_text(img_path, ref):
     assert set([x.text for x in out]) == set(ref)
 
 
+def test_find_text_regions():
+    page = Image.new('L', (2000, 3000), color=255)
+    assert dut.find_text_regions(page) == []
+    ImageDraw.Draw(page).text((100, 100), 'Hello world', fill=0)
+    ImageDraw.Draw(page).text((1500, 2500), 'island', fill=0)
+    regions = dut.find_text_regions(page)
+    assert len(regions) == 2
+    (left, top, right, bottom), _ = regions
+    assert left <= 100 < right and top <= 100 < bottom
+
+
+def test_find_text_regions_rejects_textured_pages():
+    page = Image.effect_noise((2480, 3508), 64)  # A4 at 300 dpi
+    assert dut.find_text_regions(page) == [(0, 0, 2480, 3508)]
+
+
+def test_detect_text_runs_many_regions_as_one_page(mocker):
+    mocker.patch.object(dut, 'find_text_regions', return_value=[(10 * i, 0, 10 * i + 5, 5) for i in range(40)])
+    image_to_boxes = mocker.patch.object(dut, 'image_to_boxes', return_value=BoxTable())
+    stats = dut.TextRegionStats()
+    dut.detect_text(dut.warm_up_image(), text_regions=True, stats=stats)
+    image_to_boxes.assert_called_once()
+    assert stats.many_regions == 1
+
+
+def test_merge_regions():
+    assert dut.merge_regions([(0, 0, 10, 10), (5, 5, 20, 20), (30, 30, 40, 40)]) == [(0, 0, 20, 20),
+                                                                                      (30, 30, 40, 40)]
+    assert dut.merge_regions([(0, 0, 10, 10), (30, 30, 40, 40), (5, 5, 35, 35)]) == [(0, 0, 40, 40)]
+
+
+def test_detect_text_skips_blank_pages(mocker):
+    image_to_boxes = mocker.patch.object(dut, 'image_to_boxes')
+    buffer = dut.io.BytesIO()
+    Image.new('L', (640, 480), color=255).save(buffer, format='PNG')
+    stats = dut.TextRegionStats()
+    assert len(dut.detect_text(buffer.getvalue(), text_regions=True, stats=stats)) == 0
+    image_to_boxes.assert_not_called()
+    assert stats.summary()['skipped_rate'] == 1
+
+
+def test_detect_text_offsets_regions(mocker):
+    mocker.patch.object(dut, 'find_text_regions', return_value=[(10, 20, 30, 40)])
+    mocker.patch('pytesseract.image_to_data', return_value='\t'.join(['h'] * 12) + '\n'
+                 + '\t'.join(['5', '1', '1', '1', '1', '1', '2', '3', '4', '5', '96', 'word']))
+    out = dut.detect_text(dut.warm_up_image(), text_regions=True)
+    assert list(out) == [TextBoundingBox('word', left=12, right=16, top=23, bottom=28)]
+
+
 class TestServiceOCR:
     def test_process_message(self, mocker):
-        mocker.patch.object(dut, 'detect_text', return_value=[dut.TextBoundingBox('', 1, 2, 3, 4)])
-        mocker.patch.object(dut, 'pika', mocker.MagicMock())
+        mocker.patch.object(dut, 'detect_text', return_value=BoxTable.from_boxes([TextBoundingBox('', 1, 2, 3, 4)]))
+        mocker.patch.object(dut, 'connect')
         socr = dut.ServiceOCR('host', 'a', 'b', 'b')
         out = socr.process_message(b'')
         assert isinstance(out, bytes)
         out_unpack = dut.json.loads(out.decode())
         assert isinstance(out_unpack, list)
         assert out_unpack[0] == dict(text='', left=1, right=2, top=3, bottom=4)
+
+    def test_warm_up(self, mocker):
+        detect_text = mocker.patch.object(dut, 'detect_text', return_value=[])
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'a', 'b', 'b')
+        socr.warm_up()
+        detect_text.assert_called_once_with(dut.warm_up_image(), lang=None)
+
+    def test_run_skips_completed_messages(self, mocker):
+        mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'a', 'b', 'b')
+        properties = mocker.Mock(correlation_id='id-1')
+        socr.channel_consume = mocker.MagicMock()
+        socr.channel_consume.consume.return_value = [(mocker.Mock(delivery_tag=1), properties, b''),
+                                                     (mocker.Mock(delivery_tag=2), properties, b'')]
+        socr.run()
+        socr.channel_publish.basic_publish.assert_called_once()
+        assert socr.channel_consume.basic_ack.call_count == 2
+        assert socr.metrics()['duplicates'] == 1
+
+    def test_run_pauses_while_output_queue_is_full(self, mocker):
+        mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'a', 'b', 'b')
+        socr.channel_consume = mocker.MagicMock()
+        properties = mocker.Mock(correlation_id='id-1')
+        socr.channel_consume.consume.return_value = [(mocker.Mock(delivery_tag=1), properties, b'')]
+        socr.channel_publish.basic_publish.side_effect = [dut.NackError([]), dut.NackError([]), None]
+        heartbeat = mocker.spy(socr.probes, 'heartbeat')
+        socr.run()
+        assert socr.connection.sleep.call_args_list == [mocker.call(0.1), mocker.call(0.2)]
+        assert heartbeat.call_count == 3  # the message and both pauses, throttled is not stuck
+        socr.channel_consume.basic_ack.assert_called_once_with(delivery_tag=1)
+        socr.channel_consume.basic_nack.assert_not_called()
+
+    def test_language_lane(self, mocker):
+        detect_text = mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'ocr_in.deu', 'b', 'b', lang='deu')
+        socr.channel_consume.queue_bind.assert_any_call(queue='ocr_in.deu', exchange='ocr', routing_key='deu')
+        socr.process_message(b'', dict(lang='fra'))
+        assert detect_text.call_args.kwargs['lang'] == 'deu'
+
+    @pytest.mark.parametrize('consumers, released', [(0, True), (1, False)])
+    def test_stopping_lane_worker_releases_lane(self, mocker, consumers, released):
+        mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'ocr_in.deu', 'b', 'b', lang='deu')
+        socr.channel_consume.consume.return_value = []
+        socr.channel_consume.queue_declare.return_value.method.consumer_count = consumers
+        socr.run()
+        assert socr.channel_consume.queue_unbind.called == released
+        if released:
+            socr.channel_consume.queue_unbind.assert_called_once_with(queue='ocr_in.deu', exchange='ocr',
+                                                                      routing_key='deu')
+
+    def test_missing_language_uses_default_model(self, mocker, tesseract_models):
+        detect_text = mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        tesseract_models.return_value = ['eng', 'osd']
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'ocr_in', 'b', 'b')
+        socr.warm_up()
+        socr.process_message(b'', dict(lang='fra'))
+        assert detect_text.call_args.kwargs['lang'] is None
+        socr.process_message(b'', dict(lang='eng'))
+        assert detect_text.call_args.kwargs['lang'] == 'eng'
+        assert socr.metrics()['missing_languages'] == {'fra': 1}
+
+    def test_fallback_lane_uses_message_language(self, mocker):
+        detect_text = mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'ocr_in', 'b', 'b')
+        socr.process_message(b'', dict(lang='fra'))
+        assert detect_text.call_args.kwargs['lang'] == 'fra'
+
+
+@pytest.mark.parametrize('headers, lang', [
+    (None, None), ({}, None), (dict(lang='eng'), 'eng'), (dict(lang=b'deu+eng'), 'deu+eng'),
+    (dict(lang='-l eng; rm'), None), (dict(lang=3), None),
+])
+def test_message_language(headers, lang):
+    assert dut.message_language(headers) == lang
+
+
+class TestServiceOCRTenants:
+    def test_run_serves_tenant_queues(self, mocker):
+        mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'ocr_in', 'b', 'b', tenants={'acme': 2})
+        socr.channel_consume.queue_bind.assert_any_call(queue='ocr_tenant.acme', exchange='ocr_tenant',
+                                                        routing_key='acme')
+        backlog = {'ocr_in': ['id-1'], 'ocr_tenant.acme': ['id-2', 'id-3']}
+
+        def basic_get(queue):
+            if not backlog[queue]:
+                return None, None, None
+            return (mocker.Mock(delivery_tag=1, message_count=len(backlog[queue]) - 1),
+                    mocker.Mock(correlation_id=backlog[queue].pop(0), headers={}), b'')
+        socr.channel_consume.basic_get.side_effect = basic_get
+        socr.connection.sleep.side_effect = lambda delay: socr.stop()  # stop once all queues are empty
+        socr.run()
+        assert socr.channel_publish.basic_publish.call_count == 3
+        tenants = socr.metrics()['tenants']
+        assert tenants['acme']['served'] == 2
+        assert tenants['*']['served'] == 1
+
+    def test_lane_worker_uses_message_language_for_tenant_queues(self, mocker):
+        detect_text = mocker.patch.object(dut, 'detect_text', return_value=BoxTable())
+        mocker.patch.object(dut, 'connect')
+        socr = dut.ServiceOCR('host', 'ocr_in.deu', 'b', 'b', lang='deu', tenants={'acme': 1})
+        backlog = {'ocr_in.deu': [dict(lang='deu')], 'ocr_tenant.acme': [dict(lang='fra')]}
+
+        def basic_get(queue):
+            if not backlog[queue]:
+                return None, None, None
+            return (mocker.Mock(delivery_tag=1, message_count=0),
+                    mocker.Mock(correlation_id=queue, headers=backlog[queue].pop(0)), b'')
+        socr.channel_consume.basic_get.side_effect = basic_get
+        socr.connection.sleep.side_effect = lambda delay: socr.stop()
+        socr.run()
+        assert [x.kwargs['lang'] for x in detect_text.call_args_list[1:]] == ['deu', 'fra']  # after the warm up
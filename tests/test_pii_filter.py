@@ -0,0 +1,48 @@
+import json
+from pii_filter import run as dut
+from common.boxes import BoxTable, TextBoundingBox
+
+
+def test_filter_to_pii():
+    boxes = BoxTable.from_boxes([TextBoundingBox('Alice', 1, 2, 3, 4), TextBoundingBox('kitten', 5, 6, 7, 8)])
+    assert list(dut.filter_to_pii(boxes, ['alice'])) == [boxes[1]]
+    assert dut.filter_to_pii(boxes, []) == boxes
+
+
+class TestServiceFilter:
+    def test_process_message(self, mocker):
+        mocker.patch.object(dut, 'connect')
+        service = dut.ServiceFilter('host', 15, 'a', 'b', 'c')
+        message_a = json.dumps([dict(text='Alice', left=1, right=2, top=3, bottom=4),
+                                dict(text='kitten', left=5, right=6, top=7, bottom=8)]).encode()
+        out = service.process_message(message_a, json.dumps(['alice']).encode())
+        assert json.loads(out.decode()) == [dict(text='kitten', left=5, right=6, top=7, bottom=8)]
+
+    def test_publish_waits_for_room(self, mocker):
+        mocker.patch.object(dut, 'connect')
+        service = dut.ServiceFilter('host', 15, 'a', 'pii', 'pii_out')
+        limit = dut.QUEUE_LIMITS['pii_sink']['max_length']
+        counts = iter([limit, limit - 1, 0])
+        service.channel_room.queue_declare.side_effect = lambda **kwargs: mocker.Mock(
+            method=mocker.Mock(message_count=next(counts)))
+        assert service.publish(b'[]', mocker.Mock())
+        assert service.connection.sleep.call_count == 2  # paused till pii_sink dropped below the headroom
+        service.channel_publish.basic_publish.assert_called_once()
+
+    def test_publish_does_not_retry_nacks(self, mocker):
+        mocker.patch.object(dut, 'connect')
+        service = dut.ServiceFilter('host', 15, 'a', 'pii', 'pii_out')
+        service.channel_room.queue_declare.side_effect = dut.ChannelClosedByBroker(404, 'NOT_FOUND')
+        service.channel_publish.basic_publish.side_effect = dut.NackError([])
+        service.publish(b'[]', mocker.Mock())
+        service.channel_publish.basic_publish.assert_called_once()  # the other bound queues already got it
+        assert service.metrics()['rejected'] == 1
+
+    def test_stopping_while_waiting_for_room_does_not_publish(self, mocker):
+        mocker.patch.object(dut, 'connect')
+        service = dut.ServiceFilter('host', 15, 'a', 'pii', 'pii_out')
+        full = dut.QUEUE_LIMITS['pii_sink']['max_length']
+        service.channel_room.queue_declare.return_value.method.message_count = full
+        service.stopping = True
+        assert not service.publish(b'[]', mocker.Mock())
+        service.channel_publish.basic_publish.assert_not_called()
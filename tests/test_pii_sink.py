@@ -0,0 +1,91 @@
+import json
+import pytest
+from pii_sink import run as dut
+
+BOXES = json.dumps([dict(text='kitten', left=5, right=6, top=7, bottom=8)]).encode()
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_segment_writer(tmp_path, binary):
+    writer = dut.SegmentWriter(str(tmp_path), segment_bytes=100, binary=binary, index=True)
+    for i in range(3):
+        writer.append(f'id-{i}', BOXES)
+    writer.flush()
+    writer.append('id-3', BOXES)
+    writer.close()
+    assert len(list(tmp_path.glob('segment-*'))) == 2  # rotated after the first batch
+    reopened = dut.SegmentWriter(str(tmp_path), binary=binary, index=True)
+    assert json.loads(reopened.lookup('id-1')) == json.loads(BOXES)
+    assert json.loads(reopened.lookup('id-3')) == json.loads(BOXES)
+    assert reopened.lookup('missing') is None
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_segment_writer_without_correlation_id(tmp_path, binary):
+    writer = dut.SegmentWriter(str(tmp_path), binary=binary, index=True)
+    writer.append(None, BOXES)
+    writer.append('id-0', BOXES)
+    writer.close()
+    assert json.loads(writer.lookup('id-0')) == json.loads(BOXES)
+    assert list(writer.index) == ['id-0']
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_segment_writer_reopens_after_torn_write(tmp_path, binary):
+    writer = dut.SegmentWriter(str(tmp_path), binary=binary, index=True)
+    writer.append('id-0', BOXES)
+    writer.close()
+    segment = next(tmp_path.glob('segment-*'))
+    length = segment.stat().st_size
+    with open(segment, 'ab') as fh:  # crashed half way through the next flush
+        fh.write(writer.encode('id-1', BOXES)[:-5])
+    with open(tmp_path / 'index.jsonl', 'a') as fh:
+        fh.write('["id-1", 0, ')
+    reopened = dut.SegmentWriter(str(tmp_path), binary=binary, index=True)
+    assert segment.stat().st_size == length
+    reopened.append('id-1', BOXES)  # the redelivered batch
+    reopened.close()
+    again = dut.SegmentWriter(str(tmp_path), binary=binary, index=True)
+    assert json.loads(again.lookup('id-0')) == json.loads(again.lookup('id-1')) == json.loads(BOXES)
+    assert segment.stat().st_size == 2 * length
+
+
+def test_segment_writer_jsonl(tmp_path):
+    writer = dut.SegmentWriter(str(tmp_path))
+    writer.append('id-0', BOXES)
+    writer.close()
+    lines = (tmp_path / 'segment-000000.jsonl').read_text().splitlines()
+    assert [json.loads(x) for x in lines] == [dict(correlation_id='id-0', boxes=json.loads(BOXES))]
+
+
+def test_sink_acks_after_flush(tmp_path, mocker):
+    mocker.patch.object(dut, 'connect')
+    writer = dut.SegmentWriter(str(tmp_path))
+    flush = mocker.spy(writer, 'flush')
+    service = dut.ServiceSink('host', 'pii_out', 'pii_sink', writer, batch=2)
+    properties = mocker.Mock(correlation_id='id', headers=dict(ingest_ts=0.0))
+    messages = [(mocker.Mock(delivery_tag=tag), properties, BOXES) for tag in (1, 2, 3)]
+    service.channel.consume.return_value = messages + [(None, None, None)]  # then a flush_interval timeout
+    service.run()
+    assert service.channel.basic_ack.call_args_list == [mocker.call(delivery_tag=2, multiple=True),
+                                                        mocker.call(delivery_tag=3, multiple=True)]
+    assert flush.call_count >= 2
+    assert service.metrics()['drained'] == 3
+    assert service.metrics()['latency']['count'] == 3
+
+
+def test_sink_flushes_a_trickle(tmp_path, mocker):
+    mocker.patch.object(dut, 'connect')
+    monotonic = mocker.patch.object(dut.time, 'monotonic', return_value=0.0)
+    service = dut.ServiceSink('host', 'pii_out', 'pii_sink', dut.SegmentWriter(str(tmp_path)), batch=500,
+                              flush_interval=0.2)
+    properties = mocker.Mock(correlation_id='id', headers={})
+
+    def trickle():  # a message every 0.1 s, the inactivity timeout never fires
+        for tag in range(1, 6):
+            monotonic.return_value = tag * 0.1
+            yield mocker.Mock(delivery_tag=tag), properties, BOXES
+    service.channel.consume.return_value = trickle()
+    service.run()
+    assert service.channel.basic_ack.call_args_list[:2] == [mocker.call(delivery_tag=3, multiple=True),
+                                                            mocker.call(delivery_tag=5, multiple=True)]
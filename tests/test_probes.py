@@ -0,0 +1,41 @@
+import pytest
+import urllib.request
+from urllib.error import HTTPError
+from common.probes import Probes
+
+
+@pytest.fixture
+def probes():
+    probes = Probes(port=18080)
+    probes.serve()
+    yield probes
+    probes.server.shutdown()
+    probes.server.server_close()
+
+
+def get(path):
+    try:
+        return urllib.request.urlopen(f'http://localhost:18080{path}').status
+    except HTTPError as e:
+        return e.code
+
+
+def test_probes(probes):
+    assert get('/live') == 200
+    assert get('/ready') == 503
+    probes.ready = True
+    assert get('/ready') == 200
+    probes.live = False
+    assert get('/live') == 503
+    assert get('/other') == 404
+
+
+def test_probes_heartbeat(probes, mocker):
+    monotonic = mocker.patch('common.probes.time.monotonic', return_value=1000.0)
+    probes.heartbeat()
+    monotonic.return_value = 1059.0
+    assert get('/live') == 200
+    monotonic.return_value = 1061.0
+    assert get('/live') == 503  # the loop is wedged
+    probes.heartbeat()
+    assert get('/live') == 200
@@ -0,0 +1,71 @@
+import pstats
+import signal
+import tracemalloc
+from common.profiling import Profiling, SectionTimers
+
+
+def test_section_timers():
+    timers = SectionTimers()
+    with timers.section('process'):
+        pass
+    timers.add('process', 2.0)
+    timers.add('ack', 0.5)
+    summary = timers.summary()
+    assert summary['process']['count'] == 2
+    assert summary['process']['max'] == 2.0
+    assert summary['ack'] == dict(count=1, total=0.5, mean=0.5, max=0.5)
+
+
+def test_profile(tmp_path):
+    profiling = Profiling(str(tmp_path), seconds=0)
+    profiling.toggle_profile()
+    sum(range(1000))
+    profiling.toggle_profile()
+    assert profiling.profile is None
+    files = list(tmp_path.glob('*.prof'))
+    assert len(files) == 1
+    pstats.Stats(str(files[0]))
+
+
+def test_snapshot(tmp_path):
+    profiling = Profiling(str(tmp_path))
+    assert profiling.take_snapshot() is None  # starts tracing
+    try:
+        buffer = [bytes(1000) for _ in range(100)]
+        first = profiling.take_snapshot()
+        buffer.extend(bytes(1000) for _ in range(100))
+        second = profiling.take_snapshot()
+    finally:
+        profiling.stop_tracing()
+    assert not tracemalloc.is_tracing()
+    assert first != second
+    assert len(list(tmp_path.glob('*.snapshot'))) == 3  # and the final one
+    assert 'test_profiling.py' in open(second).read()
+
+
+def test_tracing_time_limit(tmp_path, mocker):
+    setitimer = mocker.patch('common.profiling.signal.setitimer')
+    monotonic = mocker.patch('common.profiling.time.monotonic', return_value=100.0)
+    profiling = Profiling(str(tmp_path), seconds=30)
+    profiling.take_snapshot()
+    try:
+        setitimer.assert_called_with(signal.ITIMER_REAL, 30)
+        monotonic.return_value = 129.0
+        profiling.expire()
+        assert tracemalloc.is_tracing()
+        monotonic.return_value = 130.0
+        profiling.expire()
+        assert not tracemalloc.is_tracing()
+        setitimer.assert_called_with(signal.ITIMER_REAL, 0)
+    finally:
+        profiling.stop_tracing()
+
+
+def test_file_limit_and_endpoints(tmp_path):
+    assert Profiling().routes() == {}
+    profiling = Profiling(str(tmp_path), seconds=0, max_files=1)
+    assert set(profiling.routes()) == {'/profile', '/snapshot'}
+    for _ in range(2):
+        profiling.toggle_profile()
+        profiling.toggle_profile()
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,20 @@
+from common.queues import queue_arguments
+
+
+def test_queue_arguments(monkeypatch):
+    monkeypatch.delenv('QUEUE_TYPE', raising=False)
+    assert queue_arguments('ocr_out')['x-overflow'] == 'reject-publish'
+    assert 'x-max-length' in queue_arguments('ocr_in')
+    assert queue_arguments('other') == {}
+    assert queue_arguments('') == {}
+    lane = queue_arguments('ocr_in.deu')
+    assert lane['x-max-length'] == queue_arguments('ocr_in')['x-max-length']
+    assert lane['x-dead-letter-exchange'] == 'ocr_fallback'
+    assert lane['x-dead-letter-strategy'] == 'at-least-once'
+    assert lane['x-queue-type'] == 'quorum'
+    monkeypatch.setenv('QUEUE_TYPE', 'quorum')
+    assert queue_arguments('other') == {'x-queue-type': 'quorum'}
+    assert queue_arguments('') == {}
+    monkeypatch.setenv('QUEUE_TYPE', 'lazy')
+    assert queue_arguments('ocr_in')['x-queue-mode'] == 'lazy'
+    assert 'x-queue-mode' not in queue_arguments('ocr_in.deu')  # lanes are always quorum queues
@@ -0,0 +1,58 @@
+from unittest.mock import Mock
+from common.scheduler import TenantScheduler, parse_tenants
+
+
+def queues(**backlogs):
+    """Fake tenant queues and a get counting the polls per queue"""
+    polls = {x: 0 for x in backlogs}
+
+    def get(queue):
+        polls[queue] += 1
+        if not backlogs[queue]:
+            return None
+        backlogs[queue] -= 1
+        return Mock(message_count=backlogs[queue]), Mock(headers={}), b''
+    return get, polls
+
+
+def drain(scheduler, get, count):
+    served = []
+    for _ in range(count):
+        tenant, _ = scheduler.next(get)
+        scheduler.done(tenant)
+        served.append(tenant)
+    return served
+
+
+def test_parse_tenants():
+    assert parse_tenants('acme:3, globex,*:2') == {'acme': 3, 'globex': 1, '*': 2}
+    assert parse_tenants(None) == {}
+
+
+def test_weighted_round_robin():
+    get, _ = queues(a=100, b=100, c=100)
+    scheduler = TenantScheduler({'a': 'a', 'b': 'b', 'c': 'c'}, {'a': 3, 'b': 1})
+    assert drain(scheduler, get, 10) == ['a', 'a', 'a', 'b', 'c', 'a', 'a', 'a', 'b', 'c']
+    assert scheduler.summary()['a']['backlog'] == 94
+
+
+def test_burst_does_not_starve_others():
+    get, _ = queues(bulk=200_000, small=2)
+    scheduler = TenantScheduler({'bulk': 'bulk', 'small': 'small'}, {})
+    assert drain(scheduler, get, 4) == ['bulk', 'small', 'bulk', 'small']
+
+
+def test_single_active_tenant_is_served_back_to_back():
+    get, polls = queues(a=1000, idle_1=0, idle_2=0)
+    scheduler = TenantScheduler({'a': 'a', 'idle_1': 'idle_1', 'idle_2': 'idle_2'}, {}, idle_poll=60)
+    assert drain(scheduler, get, 100) == ['a'] * 100
+    assert polls == {'a': 100, 'idle_1': 1, 'idle_2': 1}
+
+
+def test_latency():
+    get, _ = queues(a=10)
+    scheduler = TenantScheduler({'a': 'a'}, {})
+    tenant, _ = scheduler.next(get)
+    scheduler.done(tenant, {'ingest_ts': 0.0})
+    assert scheduler.summary()['a']['served'] == 1
+    assert scheduler.summary()['a']['latency_max'] > 0
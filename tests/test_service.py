@@ -0,0 +1,18 @@
+import json
+from pika.exceptions import AMQPConnectionError
+from common import service as dut
+from common.profiling import Profiling
+
+
+def test_connect_retries_until_broker_is_ready(mocker):
+    pika = mocker.patch.object(dut, 'pika')
+    mocker.patch('time.sleep')
+    pika.BlockingConnection.side_effect = [AMQPConnectionError, AMQPConnectionError, mocker.MagicMock()]
+    dut.connect('host')
+    assert pika.BlockingConnection.call_count == 3
+
+
+def test_serve_probes():
+    probes = dut.serve_probes(None, 60, lambda: dict(drained=1), Profiling('/tmp'))
+    assert json.loads(probes.routes['/metrics']()) == dict(drained=1)
+    assert '/profile' in probes.routes